@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import perft
+from engine import ALL_CASTLING, GameState
+from search import KING_ENDGAME_TABLE, PIECE_SQUARE_TABLES, PIECE_VALUES, evaluate as evaluate_position
+
+# Positions are packed as rows of 64 int8 codes in GameState.squares order (a8 first): 0 is an empty square,
+# 1-6 are white P, N, B, R, Q, K and the negated codes are the black pieces.
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(1, 7)
+PIECE_TYPES = 'PNBRQK'
+PIECE_CODES = {'--': 0}
+for _code, _kind in enumerate(PIECE_TYPES, 1):
+    PIECE_CODES['w' + _kind] = _code
+    PIECE_CODES['b' + _kind] = -_code
+CODE_PIECES = {code: piece for piece, code in PIECE_CODES.items()}
+
+KNIGHT_OFFSETS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+KING_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+ROOK_DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+def score_tables(king_table):
+    # Row code + 6 of the result holds material plus piece-square score of that piece on every square, from
+    # white's point of view, so a whole batch is scored with one gather and one sum.
+    tables = np.zeros((13, 64), dtype=np.int32)
+    for code, kind in enumerate(PIECE_TYPES, 1):
+        table = np.array(king_table if kind == 'K' else PIECE_SQUARE_TABLES[kind], dtype=np.int32)
+        tables[6 + code] = PIECE_VALUES[kind] + table
+        tables[6 - code] = -(PIECE_VALUES[kind] + table[np.arange(64) ^ 56])
+    return tables
+
+
+MIDDLEGAME_SCORES = score_tables(PIECE_SQUARE_TABLES['K'])
+ENDGAME_SCORES = score_tables(KING_ENDGAME_TABLE)
+
+
+def pack(game_states):
+    return np.array([[PIECE_CODES[piece] for piece in game_state.squares] for game_state in game_states],
+                    dtype=np.int8).reshape(-1, 64)
+
+
+def pack_boards(boards):
+    return np.array([[PIECE_CODES[piece] for row in board for piece in row] for board in boards],
+                    dtype=np.int8).reshape(-1, 64)
+
+
+def side_to_move(game_states):
+    return np.array([game_state.white_to_move for game_state in game_states], dtype=bool)
+
+
+def unpack_boards(positions):
+    return [[[CODE_PIECES[code] for code in row] for row in position.reshape(8, 8).tolist()]
+            for position in np.asarray(positions, dtype=np.int8).reshape(-1, 64)]
+
+
+def unpack(positions, white_to_move=None):
+    # The packed form carries no castling or en-passant state; castling is assumed wherever king and rook are
+    # still on their home squares.
+    positions = np.asarray(positions, dtype=np.int8).reshape(-1, 64)
+    game_states = []
+    for index, position in enumerate(positions.tolist()):
+        squares = [CODE_PIECES[code] for code in position]
+        side = True if white_to_move is None else bool(white_to_move[index])
+        game_states.append(GameState.from_squares(squares, side, ALL_CASTLING))
+    return game_states
+
+
+def shift(masks, rows, columns):
+    shifted = np.zeros_like(masks)
+    shifted[:, max(rows, 0):8 + min(rows, 0), max(columns, 0):8 + min(columns, 0)] = \
+        masks[:, max(-rows, 0):8 + min(-rows, 0), max(-columns, 0):8 + min(-columns, 0)]
+    return shifted
+
+
+def piece_attacks(positions, white=True):
+    # Yields (piece type, attacked squares) pairs as (N, 8, 8) masks. Within one pair no square is reached by two
+    # different pieces, so summing the counts gives per-piece totals.
+    boards = np.asarray(positions, dtype=np.int8).reshape(-1, 8, 8)
+    pieces = boards if white else -boards
+    empty = boards == 0
+
+    pawns = pieces == PAWN
+    forward = -1 if white else 1
+    yield PAWN, shift(pawns, forward, -1)
+    yield PAWN, shift(pawns, forward, 1)
+
+    for kind, offsets in ((KNIGHT, KNIGHT_OFFSETS), (KING, KING_OFFSETS)):
+        movers = pieces == kind
+        for rows, columns in offsets:
+            yield kind, shift(movers, rows, columns)
+
+    for kind, directions in ((BISHOP, BISHOP_DIRECTIONS), (ROOK, ROOK_DIRECTIONS), (QUEEN, KING_OFFSETS)):
+        sliders = pieces == kind
+        for rows, columns in directions:
+            front = shift(sliders, rows, columns)
+            while front.any():
+                yield kind, front
+                front = shift(front & empty, rows, columns)
+
+
+def attack_maps(positions, white=True):
+    positions = np.asarray(positions, dtype=np.int8).reshape(-1, 64)
+    attacked = np.zeros((len(positions), 8, 8), dtype=bool)
+    for _, attacks in piece_attacks(positions, white):
+        attacked |= attacks
+    return attacked.reshape(-1, 64)
+
+
+def mobility(positions, white=True):
+    # Squares reachable by knights, bishops, rooks, queens and the king that are not blocked by an own piece.
+    positions = np.asarray(positions, dtype=np.int8).reshape(-1, 64)
+    available = ~(positions > 0 if white else positions < 0).reshape(-1, 8, 8)
+    counts = np.zeros(len(positions), dtype=np.int32)
+    for kind, attacks in piece_attacks(positions, white):
+        if kind != PAWN:
+            counts += (attacks & available).sum(axis=(1, 2))
+    return counts
+
+
+def evaluate(positions, white_to_move=None):
+    # Matches search.evaluate: side-relative when white_to_move is given, from white's point of view otherwise.
+    positions = np.asarray(positions, dtype=np.int8).reshape(-1, 64)
+    index = positions.astype(np.intp) + 6
+    squares = np.arange(64)
+    kinds = np.abs(positions)
+    endgame = ~(kinds == QUEEN).any(axis=1) | (((kinds >= KNIGHT) & (kinds <= ROOK)).sum(axis=1) <= 2)
+    scores = np.where(endgame, ENDGAME_SCORES[index, squares].sum(axis=1),
+                      MIDDLEGAME_SCORES[index, squares].sum(axis=1))
+    if white_to_move is not None:
+        scores = np.where(white_to_move, scores, -scores)
+    return scores
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare batch evaluation against the per-position evaluator.')
+    parser.add_argument('--count', type=int, default=10000, help='number of positions in the batch')
+    args = parser.parse_args(argv)
+
+    fens = [fen for fen, _ in perft.POSITIONS.values()]
+    game_states = [GameState.from_fen(fens[index % len(fens)]) for index in range(args.count)]
+
+    start = time.perf_counter()
+    expected = [evaluate_position(game_state) for game_state in game_states]
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    positions = pack(game_states)
+    scores = evaluate(positions, side_to_move(game_states))
+    white_mobility = mobility(positions, True)
+    black_mobility = mobility(positions, False)
+    batched = time.perf_counter() - start
+
+    mismatches = int((scores != np.array(expected)).sum())
+    print(f'positions: {args.count}  single: {single:.3f}s  batch (pack, evaluate, mobility): {batched:.3f}s  '
+          f'mismatches: {mismatches}  mean mobility: {white_mobility.mean():.1f} / {black_mobility.mean():.1f}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+PIECES = ('wP', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bP', 'bN', 'bB', 'bR', 'bQ', 'bK')
+
+FULL = (1 << 64) - 1
+SQUARE_BITS = [1 << square for square in range(64)]
+FILE_A = sum(1 << (row * 8) for row in range(8))
+FILE_H = FILE_A << 7
+LIGHT_SQUARES = sum(1 << square for square in range(64) if (square // 8 + square % 8) % 2 == 0)
+DARK_SQUARES = FULL ^ LIGHT_SQUARES
+
+
+def step_attacks(offsets):
+    table = []
+    for square in range(64):
+        row, column = divmod(square, 8)
+        attacks = 0
+        for offset in offsets:
+            end_row = row + offset[0]
+            end_column = column + offset[1]
+            if 0 <= end_row < 8 and 0 <= end_column < 8:
+                attacks |= 1 << (end_row * 8 + end_column)
+        table.append(attacks)
+    return table
+
+
+def ray_attacks(direction):
+    table = []
+    for square in range(64):
+        row, column = divmod(square, 8)
+        attacks = 0
+        for i in range(1, 8):
+            end_row = row + direction[0] * i
+            end_column = column + direction[1] * i
+            if 0 <= end_row < 8 and 0 <= end_column < 8:
+                attacks |= 1 << (end_row * 8 + end_column)
+            else:
+                break
+        table.append(attacks)
+    return table
+
+
+KNIGHT_ATTACKS = step_attacks(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+KING_ATTACKS = step_attacks(((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)))
+PAWN_ATTACKS = {
+    'w': step_attacks(((-1, -1), (-1, 1))),
+    'b': step_attacks(((1, -1), (1, 1)))
+}
+
+# Row 0 is the eighth rank, so "north" rays run towards lower square indices.
+NORTH = ray_attacks((-1, 0))
+SOUTH = ray_attacks((1, 0))
+WEST = ray_attacks((0, -1))
+EAST = ray_attacks((0, 1))
+NORTH_WEST = ray_attacks((-1, -1))
+NORTH_EAST = ray_attacks((-1, 1))
+SOUTH_WEST = ray_attacks((1, -1))
+SOUTH_EAST = ray_attacks((1, 1))
+
+ROOK_RAYS = [NORTH[square] | SOUTH[square] | WEST[square] | EAST[square] for square in range(64)]
+BISHOP_RAYS = [NORTH_WEST[square] | NORTH_EAST[square] | SOUTH_WEST[square] | SOUTH_EAST[square] for square in range(64)]
+
+
+def between_squares():
+    table = [[0] * 64 for _ in range(64)]
+    for rays, opposite in ((NORTH, SOUTH), (WEST, EAST), (NORTH_WEST, SOUTH_EAST), (NORTH_EAST, SOUTH_WEST)):
+        for start in range(64):
+            for end in iterate(rays[start]):
+                table[start][end] = rays[start] & opposite[end]
+                table[end][start] = table[start][end]
+    return table
+
+
+def pawn_attacks(color, pawns):
+    if color == 'w':
+        return ((pawns & ~FILE_A) >> 9) | ((pawns & ~FILE_H) >> 7)
+    return (((pawns & ~FILE_A) << 7) | ((pawns & ~FILE_H) << 9)) & FULL
+
+
+def rook_attacks(square, occupied):
+    north = NORTH[square]
+    blockers = north & occupied
+    if blockers:
+        north ^= NORTH[blockers.bit_length() - 1]
+
+    west = WEST[square]
+    blockers = west & occupied
+    if blockers:
+        west ^= WEST[blockers.bit_length() - 1]
+
+    south = SOUTH[square]
+    blockers = south & occupied
+    if blockers:
+        south ^= SOUTH[(blockers & -blockers).bit_length() - 1]
+
+    east = EAST[square]
+    blockers = east & occupied
+    if blockers:
+        east ^= EAST[(blockers & -blockers).bit_length() - 1]
+
+    return north | west | south | east
+
+
+def bishop_attacks(square, occupied):
+    north_west = NORTH_WEST[square]
+    blockers = north_west & occupied
+    if blockers:
+        north_west ^= NORTH_WEST[blockers.bit_length() - 1]
+
+    north_east = NORTH_EAST[square]
+    blockers = north_east & occupied
+    if blockers:
+        north_east ^= NORTH_EAST[blockers.bit_length() - 1]
+
+    south_west = SOUTH_WEST[square]
+    blockers = south_west & occupied
+    if blockers:
+        south_west ^= SOUTH_WEST[(blockers & -blockers).bit_length() - 1]
+
+    south_east = SOUTH_EAST[square]
+    blockers = south_east & occupied
+    if blockers:
+        south_east ^= SOUTH_EAST[(blockers & -blockers).bit_length() - 1]
+
+    return north_west | north_east | south_west | south_east
+
+
+def queen_attacks(square, occupied):
+    return rook_attacks(square, occupied) | bishop_attacks(square, occupied)
+
+
+def iterate(bitboard):
+    while bitboard:
+        bit = bitboard & -bitboard
+        yield bit.bit_length() - 1
+        bitboard ^= bit
+
+
+BETWEEN = between_squares()
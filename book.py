@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import mmap
+import random
+import struct
+import sys
+import time
+
+from engine import (CAPTURE, DOUBLE_PAWN_PUSH, ENPASSANT, FLAGS, KING_CASTLE, PROMOTION, QUEEN_CASTLE, START_FEN,
+                    GameState)
+from pgn import RESULTS, parse_san, read_games, tokenize
+from polyglot import polyglot_key
+
+# Books use the Polyglot .bin layout: sorted 16-byte big-endian entries of key (64 bits), move (16), weight (16)
+# and learn (32), with moves encoded as to-file | to-rank << 3 | from-file << 6 | from-rank << 9 | promotion << 12
+# and castling written as the king capturing its rook. Positions are keyed with the published Polyglot hash, so
+# books written by other tools work here and books built below work elsewhere.
+ENTRY = struct.Struct('>QHHI')
+KEY = struct.Struct('>Q')
+RESULT_WEIGHTS = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1), '*': (1, 1)}
+
+
+def encode_move(code):
+    start = code & 63
+    end = (code >> 6) & 63
+    flags = code & FLAGS
+    if flags == KING_CASTLE:
+        end = start + 3
+    elif flags == QUEEN_CASTLE:
+        end = start - 4
+    move = (end & 7) | (7 - (end >> 3)) << 3 | (start & 7) << 6 | (7 - (start >> 3)) << 9
+    if code & PROMOTION:
+        move |= (((code >> 12) & 3) + 1) << 12
+    return move
+
+
+def decode_move(game_state, move):
+    # Rebuilds the engine move code straight from the board.
+    start = ((7 - ((move >> 9) & 7)) << 3) | ((move >> 6) & 7)
+    end = ((7 - ((move >> 3) & 7)) << 3) | (move & 7)
+    squares = game_state.squares
+    piece = squares[start]
+    target = squares[end]
+    if piece[1] == 'K' and (target == piece[0] + 'R' or abs(end - start) == 2):
+        return start | (start + 2 if end > start else start - 2) << 6 | (KING_CASTLE if end > start else QUEEN_CASTLE)
+
+    flags = CAPTURE if target != '--' else 0
+    if piece[1] == 'P':
+        if (start - end) % 8 and target == '--':
+            flags = ENPASSANT
+        elif abs(start - end) == 16:
+            flags = DOUBLE_PAWN_PUSH
+        elif move >> 12:
+            flags |= PROMOTION | ((move >> 12) - 1) << 12
+    return start | end << 6 | flags
+
+
+class OpeningBook:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.data = self.file.read()
+        self.size = len(self.data) // ENTRY.size
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def entries(self, key):
+        # Binary search for the first entry with this key; entries for one position are contiguous.
+        data = self.data
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(data, middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        while low < self.size:
+            entry = ENTRY.unpack_from(data, low * ENTRY.size)
+            if entry[0] != key:
+                break
+            entries.append(entry[1:3])
+            low += 1
+        return entries
+
+    def get_moves(self, game_state):
+        # (move code, weight) pairs for the position, heaviest first. Moves are only generated on a book hit, to
+        # drop entries that are illegal here (a key collision or a broken book).
+        entries = [(move, weight) for move, weight in self.entries(polyglot_key(game_state)) if weight]
+        if not entries:
+            return []
+        legal = set(game_state.get_valid_move_codes())
+        moves = [(decode_move(game_state, move), weight) for move, weight in entries]
+        moves = [(code, weight) for code, weight in moves if code in legal]
+        moves.sort(key=lambda move: move[1], reverse=True)
+        return moves
+
+    def choose(self, game_state, mode='weighted', rng=random):
+        # 'best' plays the heaviest move; 'weighted' picks at random in proportion to the weights.
+        moves = self.get_moves(game_state)
+        if not moves:
+            return None
+        if mode == 'best':
+            return max(moves, key=lambda move: move[1])[0]
+        return rng.choices([code for code, _ in moves], weights=[weight for _, weight in moves])[0]
+
+
+def read_corpus(path):
+    # Yields (start FEN, move tokens, result) from a PGN file or from a plain list with one game of
+    # space-separated SAN or coordinate moves per line.
+    if path.endswith('.pgn'):
+        for game in read_games(path):
+            tokens = [token for token in tokenize(game.movetext) if token not in RESULTS]
+            yield game.start_fen, tokens, game.headers.get('Result', '*')
+        return
+    with open(path) as file:
+        for line in file:
+            tokens = line.split()
+            result = tokens.pop() if tokens and tokens[-1] in RESULTS else '*'
+            if tokens:
+                yield START_FEN, tokens, result
+
+
+def resolve(game_state, token):
+    for code in game_state.get_valid_move_codes():
+        if game_state.decode_move(code).get_chess_notation() == token:
+            return code
+    return parse_san(game_state, token)
+
+
+def build_book(corpus, output, plies=20, min_count=1):
+    # Weights each (position, move) pair by results for the side that played it: two points for a win and one
+    # for a draw, so moves from won games are preferred. Returns (games, entries written).
+    scores = {}
+    games = 0
+    for fen, tokens, result in corpus:
+        games += 1
+        game_state = GameState.from_fen(fen)
+        points = RESULT_WEIGHTS.get(result, (1, 1))
+        for token in tokens[:plies]:
+            try:
+                code = resolve(game_state, token)
+            except ValueError:
+                break
+            entry = (polyglot_key(game_state), encode_move(code))
+            count, weight = scores.get(entry, (0, 0))
+            scores[entry] = (count + 1, weight + points[0 if game_state.white_to_move else 1])
+            game_state.make_move(code)
+
+    entries = sorted((key, -min(weight, 0xFFFF), move) for (key, move), (count, weight) in scores.items()
+                     if count >= min_count)
+    with open(output, 'wb') as file:
+        for key, weight, move in entries:
+            file.write(ENTRY.pack(key, move, max(-weight, 1), 0))
+    return games, len(entries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or probe a Polyglot-layout opening book.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build a book from a PGN file or a move-list file')
+    build.add_argument('corpus')
+    build.add_argument('output')
+    build.add_argument('--plies', type=int, default=20, help='book depth in plies')
+    build.add_argument('--min-count', type=int, default=1, help='drop moves played fewer times than this')
+    probe = commands.add_parser('probe', help='list the book moves for a position')
+    probe.add_argument('book')
+    probe.add_argument('--fen', default=START_FEN)
+    probe.add_argument('--moves', nargs='*', default=[], help='moves to play from the FEN first')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        games, entries = build_book(read_corpus(args.corpus), args.output, args.plies, args.min_count)
+        print(f'games: {games}  entries: {entries}  time: {time.perf_counter() - start:.3f}s')
+        return 0
+
+    game_state = GameState.from_fen(args.fen)
+    for token in args.moves:
+        game_state.make_move(resolve(game_state, token))
+    with OpeningBook(args.book) as book:
+        moves = book.get_moves(game_state)
+    total = sum(weight for _, weight in moves) or 1
+    for code, weight in sorted(moves, key=lambda move: -move[1]):
+        print(f'{game_state.decode_move(code).get_chess_notation()}  weight {weight}  {weight / total:.1%}')
+    print(f'{len(moves)} book moves  time: {(time.perf_counter() - start) * 1e6:.0f} us')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
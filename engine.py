@@ -1,10 +1,47 @@
 # -*- coding: utf-8 -*-
 
-import copy
+from collections import OrderedDict
+
+from bitboard import (BETWEEN, BISHOP_RAYS, DARK_SQUARES, FULL, KING_ATTACKS, KNIGHT_ATTACKS, LIGHT_SQUARES,
+                      PAWN_ATTACKS, PIECES, ROOK_RAYS, SQUARE_BITS, bishop_attacks, pawn_attacks, queen_attacks,
+                      rook_attacks)
+from zobrist import CASTLING_KEYS, PIECE_KEYS, SIDE_KEY, enpassant_key, hash_position
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# Moves are packed into 16 bits: start square in bits 0-5, end square in bits 6-11 and flags in bits 12-15.
+DOUBLE_PAWN_PUSH = 1 << 12
+KING_CASTLE = 2 << 12
+QUEEN_CASTLE = 3 << 12
+CAPTURE = 4 << 12
+ENPASSANT = 5 << 12
+PROMOTION = 8 << 12
+FLAGS = 15 << 12
+PROMOTION_PIECES = 'NBRQ'
+SQUARE_NAMES = ['abcdefgh'[square % 8] + '87654321'[square // 8] for square in range(64)]
+
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+ALL_CASTLING = 15
+CASTLING_FLAGS = (('K', WHITE_KING_SIDE), ('Q', WHITE_QUEEN_SIDE), ('k', BLACK_KING_SIDE), ('q', BLACK_QUEEN_SIDE))
+# Castling rights kept when a piece moves from or to each square.
+CASTLING_MASKS = [ALL_CASTLING] * 64
+CASTLING_MASKS[0] = ALL_CASTLING ^ BLACK_QUEEN_SIDE
+CASTLING_MASKS[4] = ALL_CASTLING ^ BLACK_KING_SIDE ^ BLACK_QUEEN_SIDE
+CASTLING_MASKS[7] = ALL_CASTLING ^ BLACK_KING_SIDE
+CASTLING_MASKS[56] = ALL_CASTLING ^ WHITE_QUEEN_SIDE
+CASTLING_MASKS[60] = ALL_CASTLING ^ WHITE_KING_SIDE ^ WHITE_QUEEN_SIDE
+CASTLING_MASKS[63] = ALL_CASTLING ^ WHITE_KING_SIDE
+CASTLING_HOMES = ((0, 'bR'), (4, 'bK'), (7, 'bR'), (56, 'wR'), (60, 'wK'), (63, 'wR'))
+
 
 class GameState:
+    move_cache_size = 1024
+
     def __init__(self):
-        self.board = [
+        board = [
             ['bR', 'bN', 'bB', 'bQ', 'bK', 'bB', 'bN', 'bR'],
             ['bP', 'bP', 'bP', 'bP', 'bP', 'bP', 'bP', 'bP'],
             ['--', '--', '--', '--', '--', '--', '--', '--'],
@@ -14,6 +51,7 @@ class GameState:
             ['wP', 'wP', 'wP', 'wP', 'wP', 'wP', 'wP', 'wP'],
             ['wR', 'wN', 'wB', 'wQ', 'wK', 'wB', 'wN', 'wR']
         ]
+        self.set_squares([piece for row in board for piece in row])
         self.move_mapping = {
             'P': self.get_pawn_moves,
             'R': self.get_rook_moves,
@@ -24,158 +62,304 @@ class GameState:
         }
         self.white_to_move = True
         self.move_log = []
-        self.white_king_location = (7, 4)
-        self.black_king_location = (0, 4)
+        self.undo_log = []
         self.checkmate = False
         self.stalemate = False
-        self.enpassant_possible = ()
-        self.current_castling_rights = CastleRights(True, True, True, True)
-        self.castle_rights_log = [CastleRights(
-            self.current_castling_rights.white_king_side,
-            self.current_castling_rights.black_king_side,
-            self.current_castling_rights.white_queen_side,
-            self.current_castling_rights.black_queen_side
-        )]
+        self.checkers = 0
+        self.enpassant_square = None
+        self.castling = ALL_CASTLING
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.zobrist_key = self.compute_zobrist_key()
+        # Occurrences of each position key in the game so far; only reversible moves can bring a key back.
+        self.repetitions = {self.zobrist_key: 1}
+        self.move_cache = OrderedDict()
+
+    @classmethod
+    def from_fen(cls, fen):
+        # Rejects anything the move generator cannot handle: short or long ranks, pawns on the back ranks, unknown
+        # castling letters and en-passant squares on the wrong rank.
+        fields = fen.split()
+        if len(fields) < 4 or fields[1] not in ('w', 'b'):
+            raise ValueError(f'Invalid FEN: {fen!r}')
+
+        ranks = fields[0].split('/')
+        if len(ranks) != 8:
+            raise ValueError(f'Invalid FEN: {fen!r}: expected 8 ranks')
+        squares = []
+        for rank in ranks:
+            start = len(squares)
+            for char in rank:
+                if char in '12345678':
+                    squares.extend(['--'] * int(char))
+                elif char in 'PNBRQKpnbrqk':
+                    squares.append(('w' if char.isupper() else 'b') + char.upper())
+                else:
+                    raise ValueError(f'Invalid FEN: {fen!r}')
+            if len(squares) - start != 8:
+                raise ValueError(f'Invalid FEN: {fen!r}: rank {rank!r} does not cover 8 files')
+        if squares.count('wK') != 1 or squares.count('bK') != 1:
+            raise ValueError(f'Invalid FEN: {fen!r}: each side needs exactly one king')
+        if any(piece[1] == 'P' for piece in squares[:8] + squares[56:]):
+            raise ValueError(f'Invalid FEN: {fen!r}: pawn on the first or last rank')
+        try:
+            halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+            fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+        except ValueError:
+            raise ValueError(f'Invalid FEN: {fen!r}') from None
+        if halfmove_clock < 0:
+            raise ValueError(f'Invalid FEN: {fen!r}')
+
+        castling = 0
+        if fields[2] != '-':
+            for char in fields[2]:
+                right = dict(CASTLING_FLAGS).get(char)
+                if right is None or castling & right:
+                    raise ValueError(f'Invalid FEN: {fen!r}: bad castling field {fields[2]!r}')
+                castling |= right
+        if fields[3] == '-':
+            enpassant_square = None
+        elif fields[3] in SQUARE_NAMES and fields[3][1] == ('6' if fields[1] == 'w' else '3'):
+            enpassant_square = SQUARE_NAMES.index(fields[3])
+        else:
+            raise ValueError(f'Invalid FEN: {fen!r}: bad en-passant square {fields[3]!r}')
+        return cls.from_squares(squares, fields[1] == 'w', castling, enpassant_square, halfmove_clock,
+                                fullmove_number)
+
+    @classmethod
+    def from_squares(cls, squares, white_to_move=True, castling=ALL_CASTLING, enpassant_square=None,
+                     halfmove_clock=0, fullmove_number=1):
+        game_state = cls()
+        game_state.set_squares(squares)
+        game_state.white_to_move = white_to_move
+        # Rights whose king or rook is off its home square can never be used, so drop them to keep keys canonical.
+        for square, piece in CASTLING_HOMES:
+            if squares[square] != piece:
+                castling &= CASTLING_MASKS[square]
+        game_state.castling = castling
+        game_state.enpassant_square = enpassant_square
+        game_state.halfmove_clock = halfmove_clock
+        game_state.fullmove_number = max(fullmove_number, 1)
+        game_state.zobrist_key = game_state.compute_zobrist_key()
+        game_state.repetitions = {game_state.zobrist_key: 1}
+        return game_state
+
+    def __reduce__(self):
+        # Pickles (and copies) as a compact snapshot instead of the board, logs and bound move generators.
+        import snapshot
+        return snapshot.decode, (snapshot.encode(self),)
+
+    def to_fen(self):
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for piece in row:
+                if piece == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1] if piece[0] == 'w' else piece[1].lower()
+            ranks.append(rank + (str(empty) if empty else ''))
+
+        castling = ''.join(flag for flag, right in CASTLING_FLAGS if self.castling & right)
+        enpassant = SQUARE_NAMES[self.enpassant_square] if self.enpassant_square is not None else '-'
+        return (f"{'/'.join(ranks)} {'w' if self.white_to_move else 'b'} {castling or '-'} {enpassant} "
+                f"{self.halfmove_clock} {self.fullmove_number}")
+
+    def compute_zobrist_key(self):
+        return hash_position(self.squares, self.white_to_move, self.castling, self.enpassant_square)
+
+    @property
+    def board(self):
+        if self.board_view is None:
+            squares = self.squares
+            self.board_view = [squares[i:i + 8] for i in range(0, 64, 8)]
+        return self.board_view
+
+    def set_squares(self, squares):
+        self.zobrist_key = 0
+        self.squares = list(squares)
+        self.pieces = dict.fromkeys(PIECES, 0)
+        self.occupancy = {'w': 0, 'b': 0}
+        for square, piece in enumerate(self.squares):
+            if piece != '--':
+                self.pieces[piece] |= SQUARE_BITS[square]
+                self.occupancy[piece[0]] |= SQUARE_BITS[square]
+        self.occupied = self.occupancy['w'] | self.occupancy['b']
+        self.white_king_location = divmod(self.pieces['wK'].bit_length() - 1, 8)
+        self.black_king_location = divmod(self.pieces['bK'].bit_length() - 1, 8)
+        self.board_view = None
+
+    def place_piece(self, square, piece):
+        if piece == '--':
+            return
+        bit = SQUARE_BITS[square]
+        self.squares[square] = piece
+        self.pieces[piece] |= bit
+        self.occupancy[piece[0]] |= bit
+        self.occupied |= bit
+        self.zobrist_key ^= PIECE_KEYS[piece][square]
+        self.board_view = None
+
+    def remove_piece(self, square):
+        piece = self.squares[square]
+        if piece != '--':
+            bit = SQUARE_BITS[square]
+            self.squares[square] = '--'
+            self.pieces[piece] ^= bit
+            self.occupancy[piece[0]] ^= bit
+            self.occupied ^= bit
+            self.zobrist_key ^= PIECE_KEYS[piece][square]
+            self.board_view = None
+        return piece
 
     def make_move(self, move):
-        self.board[move.start_row][move.start_column] = '--'
-        self.board[move.end_row][move.end_column] = move.piece_moved
-        self.move_log.append(move)
+        code = move.code if isinstance(move, Move) else move
+        start = code & 63
+        end = (code >> 6) & 63
+        flags = code & FLAGS
+        castling = self.castling
+        enpassant_square = self.enpassant_square
+        self.undo_log.append((castling, enpassant_square, self.halfmove_clock, self.zobrist_key, self.squares[end]))
+        if enpassant_square is not None:
+            self.zobrist_key ^= enpassant_key(self.squares, enpassant_square, self.white_to_move)
+
+        piece_moved = self.remove_piece(start)
+        self.remove_piece(end)
+        if flags == ENPASSANT:
+            self.remove_piece((start & 56) | (end & 7))
+
+        if flags & PROMOTION:
+            self.place_piece(end, piece_moved[0] + PROMOTION_PIECES[(flags >> 12) & 3])
+        else:
+            self.place_piece(end, piece_moved)
+        self.move_log.append(code)
+        if flags & CAPTURE or piece_moved[1] == 'P':
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if piece_moved[0] == 'b':
+            self.fullmove_number += 1
 
-        if move.piece_moved == 'wK':
-            self.white_king_location = (move.end_row, move.end_column)
-        elif move.piece_moved == 'bK':
-            self.black_king_location = (move.end_row, move.end_column)
+        if piece_moved == 'wK':
+            self.white_king_location = divmod(end, 8)
+        elif piece_moved == 'bK':
+            self.black_king_location = divmod(end, 8)
 
         self.white_to_move = not self.white_to_move
+        self.zobrist_key ^= SIDE_KEY
 
-        if move.is_pawn_promotion:
-            self.board[move.end_row][move.end_column] = move.piece_moved[0] + 'Q'
+        if flags == KING_CASTLE:
+            self.place_piece(end - 1, self.remove_piece(end + 1))
+        elif flags == QUEEN_CASTLE:
+            self.place_piece(end + 1, self.remove_piece(end - 2))
 
-        if move.is_enpassant_move:
-            self.board[move.start_row][move.end_column] = '--'
+        self.castling = castling & CASTLING_MASKS[start] & CASTLING_MASKS[end]
+        if self.castling != castling:
+            self.zobrist_key ^= CASTLING_KEYS[castling] ^ CASTLING_KEYS[self.castling]
 
-        if move.piece_moved[1] == 'P' and abs(move.start_row - move.end_row) == 2:
-            self.enpassant_possible = ((move.start_row + move.end_row) // 2, move.start_column)
+        if flags == DOUBLE_PAWN_PUSH:
+            self.enpassant_square = (start + end) // 2
+            self.zobrist_key ^= enpassant_key(self.squares, self.enpassant_square, self.white_to_move)
         else:
-            self.enpassant_possible = ()
-
-        if move.is_castle_move:
-            if move.end_column - move.start_column == 2:
-                self.board[move.end_row][move.end_column - 1] = self.board[move.end_row][move.end_column + 1]
-                self.board[move.end_row][move.end_column + 1] = '--'
-
-            else:
-                self.board[move.end_row][move.end_column + 1] = self.board[move.end_row][move.end_column - 2]
-                self.board[move.end_row][move.end_column - 2] = '--'
-
-        self.update_castle_rights(move)
-        self.castle_rights_log.append(
-            CastleRights(
-                self.current_castling_rights.white_king_side,
-                self.current_castling_rights.black_king_side,
-                self.current_castling_rights.white_queen_side,
-                self.current_castling_rights.black_queen_side
-            )
-        )
-
-    def update_castle_rights(self, move):
-        if move.piece_moved == 'wK':
-            self.current_castling_rights.white_king_side = False
-            self.current_castling_rights.white_queen_side = False
-
-        elif move.piece_moved == 'bK':
-            self.current_castling_rights.black_king_side = False
-            self.current_castling_rights.black_queen_side = False
-
-        elif move.piece_moved == 'wR':
-            if move.start_row == 7:
-                if move.start_column == 0:
-                    self.current_castling_rights.white_queen_side = False
-                elif move.start_column == 7:
-                    self.current_castling_rights.white_king_side = False
-
-        elif move.piece_moved == 'bR':
-            if move.start_row == 0:
-                if move.start_column == 0:
-                    self.current_castling_rights.black_queen_side = False
-                elif move.start_column == 7:
-                    self.current_castling_rights.black_king_side = False
-
-        if move.piece_captured == 'wR':
-            if move.end_row == 7:
-                if move.end_column == 0:
-                    self.current_castling_rights.wqs = False
-                elif move.end_column == 7:
-                    self.current_castling_rights.wks = False
-
-        elif move.piece_captured == 'bR':
-            if move.end_row == 0:
-                if move.end_column == 0:
-                    self.current_castling_rights.bqs = False
-                elif move.end_column == 7:
-                    self.current_castling_rights.bks = False
+            self.enpassant_square = None
+        self.repetitions[self.zobrist_key] = self.repetitions.get(self.zobrist_key, 0) + 1
 
     def undo_move(self):
         if len(self.move_log) != 0:
-            move = self.move_log.pop()
-            self.board[move.start_row][move.start_column] = move.piece_moved
-            self.board[move.end_row][move.end_column] = move.piece_captured
-
-            if move.piece_moved == 'wK':
-                self.white_king_location = (move.start_row, move.start_column)
-            elif move.piece_moved == 'bK':
-                self.black_king_location = (move.start_row, move.start_column)
-
-            if move.is_enpassant_move:
-                self.board[move.end_row][move.end_column] = '--'
-                self.board[move.start_row][move.end_column] = move.piece_captured
-                self.enpassant_possible = (move.end_row, move.end_column)
-
-            if move.piece_moved[1] == 'P' and abs(move.start_row - move.end_row) == 2:
-                self.enpassant_possible = ()
-
-            self.castle_rights_log.pop()
-            self.current_castling_rights = copy.deepcopy(self.castle_rights_log[-1])
+            code = self.move_log.pop()
+            count = self.repetitions[self.zobrist_key]
+            if count == 1:
+                del self.repetitions[self.zobrist_key]
+            else:
+                self.repetitions[self.zobrist_key] = count - 1
+            self.castling, self.enpassant_square, self.halfmove_clock, zobrist_key, piece_captured = self.undo_log.pop()
+            start = code & 63
+            end = (code >> 6) & 63
+            flags = code & FLAGS
+
+            piece_moved = self.remove_piece(end)
+            if flags & PROMOTION:
+                piece_moved = piece_moved[0] + 'P'
+            self.place_piece(start, piece_moved)
+            if piece_moved[0] == 'b':
+                self.fullmove_number -= 1
+
+            if piece_moved == 'wK':
+                self.white_king_location = divmod(start, 8)
+            elif piece_moved == 'bK':
+                self.black_king_location = divmod(start, 8)
+
+            if flags == ENPASSANT:
+                self.place_piece((start & 56) | (end & 7), 'wP' if piece_moved == 'bP' else 'bP')
+            else:
+                self.place_piece(end, piece_captured)
 
-            if move.is_castle_move:
-                if move.end_column - move.start_column == 2:
-                    self.board[move.end_row][move.end_column + 1] = self.board[move.end_row][move.end_column - 1]
-                    self.board[move.end_row][move.end_column - 1] = '--'
-
-                else:
-                    self.board[move.end_row][move.end_column - 2] = self.board[move.end_row][move.end_column + 1]
-                    self.board[move.end_row][move.end_column + 1] = '--'
+            if flags == KING_CASTLE:
+                self.place_piece(end + 1, self.remove_piece(end - 1))
+            elif flags == QUEEN_CASTLE:
+                self.place_piece(end - 2, self.remove_piece(end + 1))
 
             self.white_to_move = not self.white_to_move
+            self.zobrist_key = zobrist_key
+
+    def decode_move(self, code):
+        return Move.decode(code, self.squares)
 
     def get_valid_moves(self):
-        temp_enpassant_possible = self.enpassant_possible
-        temp_castle_rights = CastleRights(
-            self.current_castling_rights.white_king_side,
-            self.current_castling_rights.black_king_side,
-            self.current_castling_rights.white_queen_side,
-            self.current_castling_rights.black_queen_side
-        )
-        moves = self.get_possible_moves()
+        key = self.zobrist_key
+        entry = self.move_cache.get(key)
+        if entry is None:
+            squares = self.squares
+            moves = tuple(Move.decode(code, squares) for code in self.get_valid_move_codes())
+            if self.move_cache_size:
+                self.move_cache[key] = (moves, self.checkmate, self.stalemate, self.checkers)
+                if len(self.move_cache) > self.move_cache_size:
+                    self.move_cache.popitem(last=False)
+        else:
+            self.move_cache.move_to_end(key)
+            moves, self.checkmate, self.stalemate, self.checkers = entry
+        return list(moves)
 
+    def get_valid_move_codes(self):
+        moves = []
         if self.white_to_move:
-            self.get_castle_moves(self.white_king_location[0], self.white_king_location[1], moves)
+            color, enemy_color = 'w', 'b'
+            king_row, king_column = self.white_king_location
         else:
-            self.get_castle_moves(self.black_king_location[0], self.black_king_location[1], moves)
-
-        for move in moves[::-1]:
-            self.make_move(move)
-            self.white_to_move = not self.white_to_move
+            color, enemy_color = 'b', 'w'
+            king_row, king_column = self.black_king_location
+        king_square = king_row * 8 + king_column
 
-            if self.in_check():
-                moves.remove(move)
+        attacked, checkers = self.get_attack_map(enemy_color, king_square)
+        self.checkers = checkers
+        self.add_moves(king_square, KING_ATTACKS[king_square] & ~self.occupancy[color] & ~attacked, moves)
 
-            self.white_to_move = not self.white_to_move
-            self.undo_move()
+        if not checkers & (checkers - 1):
+            if checkers:
+                targets = checkers | BETWEEN[king_square][checkers.bit_length() - 1]
+            else:
+                targets = FULL
+                self.get_castle_moves(king_row, king_column, moves, attacked)
+
+            pins = self.get_pins(color, king_square)
+            for piece in 'PNBRQ':
+                generator = self.move_mapping[piece]
+                bitboard = self.pieces[color + piece]
+                while bitboard:
+                    bit = bitboard & -bitboard
+                    square = bit.bit_length() - 1
+                    generator(square // 8, square % 8, moves, targets & pins.get(square, FULL))
+                    bitboard ^= bit
+
+            if self.enpassant_square is not None:
+                moves = [code for code in moves if code & FLAGS != ENPASSANT or self.enpassant_is_legal(code)]
 
         if len(moves) == 0:
-            if self.in_check():
+            if checkers:
                 self.checkmate = True
             else:
                 self.stalemate = True
@@ -183,220 +367,346 @@ class GameState:
             self.stalemate = False
             self.checkmate = False
 
-        self.enpassant_possible = temp_enpassant_possible
-        self.current_castling_rights = temp_castle_rights
         return moves
 
+    def get_attack_map(self, color, king_square):
+        pieces = self.pieces
+        king_bit = SQUARE_BITS[king_square]
+        occupied = self.occupied ^ king_bit
+        attacked = pawn_attacks(color, pieces[color + 'P'])
+        checkers = PAWN_ATTACKS['b' if color == 'w' else 'w'][king_square] & pieces[color + 'P']
+        checkers |= KNIGHT_ATTACKS[king_square] & pieces[color + 'N']
+
+        bitboard = pieces[color + 'N']
+        while bitboard:
+            bit = bitboard & -bitboard
+            attacked |= KNIGHT_ATTACKS[bit.bit_length() - 1]
+            bitboard ^= bit
+
+        for piece, attacks in (('B', bishop_attacks), ('R', rook_attacks), ('Q', queen_attacks)):
+            bitboard = pieces[color + piece]
+            while bitboard:
+                bit = bitboard & -bitboard
+                piece_attacks = attacks(bit.bit_length() - 1, occupied)
+                attacked |= piece_attacks
+                if piece_attacks & king_bit:
+                    checkers |= bit
+                bitboard ^= bit
+
+        attacked |= KING_ATTACKS[pieces[color + 'K'].bit_length() - 1]
+        return attacked, checkers
+
+    def get_pins(self, color, king_square):
+        enemy_color = 'b' if color == 'w' else 'w'
+        pieces = self.pieces
+        own = self.occupancy[color]
+        pins = {}
+        snipers = ((ROOK_RAYS[king_square] & (pieces[enemy_color + 'R'] | pieces[enemy_color + 'Q'])) |
+                   (BISHOP_RAYS[king_square] & (pieces[enemy_color + 'B'] | pieces[enemy_color + 'Q'])))
+        while snipers:
+            bit = snipers & -snipers
+            ray = BETWEEN[king_square][bit.bit_length() - 1]
+            blockers = ray & self.occupied
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pins[blockers.bit_length() - 1] = ray | bit
+            snipers ^= bit
+        return pins
+
+    def enpassant_is_legal(self, code):
+        if self.white_to_move:
+            color, enemy_color = 'w', 'b'
+            king_square = self.white_king_location[0] * 8 + self.white_king_location[1]
+        else:
+            color, enemy_color = 'b', 'w'
+            king_square = self.black_king_location[0] * 8 + self.black_king_location[1]
+        pieces = self.pieces
+        start = code & 63
+        end = (code >> 6) & 63
+        captured_bit = SQUARE_BITS[(start & 56) | (end & 7)]
+        occupied = self.occupied ^ SQUARE_BITS[start] ^ captured_bit | SQUARE_BITS[end]
+        return not (
+            PAWN_ATTACKS[color][king_square] & pieces[enemy_color + 'P'] & ~captured_bit or
+            KNIGHT_ATTACKS[king_square] & pieces[enemy_color + 'N'] or
+            rook_attacks(king_square, occupied) & (pieces[enemy_color + 'R'] | pieces[enemy_color + 'Q']) or
+            bishop_attacks(king_square, occupied) & (pieces[enemy_color + 'B'] | pieces[enemy_color + 'Q'])
+        )
+
     def in_check(self):
         if self.white_to_move:
             return self.square_under_attack(self.white_king_location[0], self.white_king_location[1])
         return self.square_under_attack(self.black_king_location[0], self.black_king_location[1])
 
+    def is_repetition(self, count=3):
+        return self.repetitions.get(self.zobrist_key, 0) >= count
+
+    def is_fifty_move_draw(self):
+        return self.halfmove_clock >= 100
+
+    def has_insufficient_material(self):
+        # Bare kings, a single minor piece, or only bishops that all stand on squares of one colour.
+        pieces = self.pieces
+        if pieces['wP'] | pieces['bP'] | pieces['wR'] | pieces['bR'] | pieces['wQ'] | pieces['bQ']:
+            return False
+        knights = pieces['wN'] | pieces['bN']
+        bishops = pieces['wB'] | pieces['bB']
+        if not knights:
+            return not bishops & LIGHT_SQUARES or not bishops & DARK_SQUARES
+        return not bishops and not knights & (knights - 1)
+
+    def get_draw_reason(self):
+        if self.has_insufficient_material():
+            return 'insufficient material'
+        if self.is_repetition():
+            return 'threefold repetition'
+        if self.is_fifty_move_draw():
+            return 'fifty-move rule'
+        return None
+
+    def get_game_status(self):
+        # One of 'checkmate', 'stalemate', a draw reason from get_draw_reason, or None while the game goes on.
+        self.get_valid_move_codes()
+        if self.checkmate:
+            return 'checkmate'
+        if self.stalemate:
+            return 'stalemate'
+        return self.get_draw_reason()
+
     def square_under_attack(self, row, column):
-        self.white_to_move = not self.white_to_move
-        opponent_moves = self.get_possible_moves()
-        self.white_to_move = not self.white_to_move
-        for move in opponent_moves:
-            if move.end_row == row and move.end_column == column:
-                return True
-        return False
+        # Looks outward from the square for an enemy pawn, knight, king or slider, stopping at the first one.
+        square = row * 8 + column
+        pieces = self.pieces
+        if self.white_to_move:
+            color, enemy_color = 'w', 'b'
+        else:
+            color, enemy_color = 'b', 'w'
+        if PAWN_ATTACKS[color][square] & pieces[enemy_color + 'P']:
+            return True
+        if KNIGHT_ATTACKS[square] & pieces[enemy_color + 'N']:
+            return True
+        if KING_ATTACKS[square] & pieces[enemy_color + 'K']:
+            return True
+        queens = pieces[enemy_color + 'Q']
+        rooks = pieces[enemy_color + 'R'] | queens
+        if ROOK_RAYS[square] & rooks and rook_attacks(square, self.occupied) & rooks:
+            return True
+        bishops = pieces[enemy_color + 'B'] | queens
+        return bool(BISHOP_RAYS[square] & bishops and bishop_attacks(square, self.occupied) & bishops)
+
+    def get_attackers(self, square, color, occupied=None):
+        # Bitboard of the pieces of color that attack square, e.g. the checkers of a king for evasion.
+        pieces = self.pieces
+        if occupied is None:
+            occupied = self.occupied
+        queens = pieces[color + 'Q']
+        return ((PAWN_ATTACKS['b' if color == 'w' else 'w'][square] & pieces[color + 'P']) |
+                (KNIGHT_ATTACKS[square] & pieces[color + 'N']) |
+                (KING_ATTACKS[square] & pieces[color + 'K']) |
+                (rook_attacks(square, occupied) & (pieces[color + 'R'] | queens)) |
+                (bishop_attacks(square, occupied) & (pieces[color + 'B'] | queens)))
 
     def get_possible_moves(self):
+        squares = self.squares
+        return [Move.decode(code, squares) for code in self.get_possible_move_codes()]
+
+    def get_possible_move_codes(self):
         moves = []
-        for row in range(len(self.board)):
-            for column in range(len(self.board[row])):
-                turn = self.board[row][column][0]
-                if (turn == 'w' and self.white_to_move) or (turn == 'b' and not self.white_to_move):
-                    piece = self.board[row][column][1]
-                    self.move_mapping[piece](row, column, moves)
+        pieces = self.pieces
+        color = 'w' if self.white_to_move else 'b'
+        for piece in 'PNBRQK':
+            generator = self.move_mapping[piece]
+            bitboard = pieces[color + piece]
+            while bitboard:
+                bit = bitboard & -bitboard
+                row, column = divmod(bit.bit_length() - 1, 8)
+                generator(row, column, moves)
+                bitboard ^= bit
         return moves
 
-    def get_pawn_moves(self, row, column, moves):
+    def add_moves(self, start, targets, moves):
+        captures = targets & self.occupancy['b' if self.white_to_move else 'w']
+        targets ^= captures
+        while targets:
+            bit = targets & -targets
+            moves.append(start | (bit.bit_length() - 1) << 6)
+            targets ^= bit
+        while captures:
+            bit = captures & -captures
+            moves.append(start | (bit.bit_length() - 1) << 6 | CAPTURE)
+            captures ^= bit
+
+    def get_pawn_moves(self, row, column, moves, targets=FULL):
+        square = row * 8 + column
         if self.white_to_move:
-            if row - 1 >= 0:
-                if self.board[row - 1][column] == '--':
-                    moves.append(Move((row, column), (row - 1, column), self.board))
-                    if row == 6 and self.board[row - 2][column] == '--':
-                        moves.append(Move((row, column), (row - 2, column), self.board))
-
-                if column - 1 >= 0:
-                    if self.board[row - 1][column - 1][0] == 'b':
-                        moves.append(Move((row, column), (row - 1, column - 1), self.board))
-                    elif (row - 1, column - 1) == self.enpassant_possible:
-                        moves.append(Move((row, column), (row - 1, column - 1), self.board, is_enpassant_move=True))
-
-                if column + 1 <= 7:
-                    if self.board[row - 1][column + 1][0] == 'b':
-                        moves.append(Move((row, column), (row - 1, column + 1), self.board))
-                    elif (row - 1, column + 1) == self.enpassant_possible:
-                        moves.append(Move((row, column), (row - 1, column + 1), self.board, is_enpassant_move=True))
-
+            color, enemy_color, forward, start_row, promotion_row = 'w', 'b', -8, 6, 1
         else:
-            if len(self.board) > row + 1:
-                if self.board[row + 1][column] == '--':
-                    moves.append(Move((row, column), (row + 1, column), self.board))
-                    if row == 1 and self.board[row + 2][column] == '--':
-                        moves.append(Move((row, column), (row + 2, column), self.board))
-
-                if column - 1 >= 0:
-                    if self.board[row + 1][column - 1][0] == 'w':
-                        moves.append(Move((row, column), (row + 1, column - 1), self.board))
-                    elif (row + 1, column - 1) == self.enpassant_possible:
-                        moves.append(Move((row, column), (row + 1, column - 1), self.board, is_enpassant_move=True))
-
-                if column + 1 <= 7:
-                    if self.board[row + 1][column + 1][0] == 'w':
-                        moves.append(Move((row, column), (row + 1, column + 1), self.board))
-                    elif (row + 1, column + 1) == self.enpassant_possible:
-                        moves.append(Move((row, column), (row + 1, column + 1), self.board, is_enpassant_move=True))
-
-    def get_rook_moves(self, row, column, moves):
-        directions = ((-1, 0), (0, -1), (1, 0), (0, 1))
-        enemy_color = 'b' if self.white_to_move else 'w'
-
-        for direction in directions:
-            for i in range(1, 8):
-                end_row = row + direction[0] * i
-                end_column = column + direction[1] * i
-
-                if 0 <= end_row < 8 and 0 <= end_column < 8:
-                    end_piece = self.board[end_row][end_column]
-
-                    if end_piece == '--':
-                        moves.append(Move((row, column), (end_row, end_column), self.board))
-
-                    elif end_piece[0] == enemy_color:
-                        moves.append(Move((row, column), (end_row, end_column), self.board))
-                        break
-
-                    else:
-                        break
+            color, enemy_color, forward, start_row, promotion_row = 'b', 'w', 8, 1, 6
 
+        if not self.occupied & SQUARE_BITS[square + forward]:
+            if targets & SQUARE_BITS[square + forward]:
+                if row == promotion_row:
+                    for promotion in range(4):
+                        moves.append(square | (square + forward) << 6 | PROMOTION | promotion << 12)
                 else:
-                    break
-
-    def get_knight_moves(self, row, column, moves):
-        knight_moves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
-        ally_color = 'w' if self.white_to_move else 'b'
-
-        for move in knight_moves:
-            end_row = row + move[0]
-            end_column = column + move[1]
-
-            if 0 <= end_row < 8 and 0 <= end_column < 8:
-                end_piece = self.board[end_row][end_column]
-
-                if end_piece[0] != ally_color:
-                    moves.append(Move((row, column), (end_row, end_column), self.board))
-
-    def get_bishop_moves(self, row, column, moves):
-        directions = ((-1, -1), (-1, 1), (1, -1), (1, 1))
-        enemy_color = 'b' if self.white_to_move else 'w'
-
-        for direction in directions:
-            for i in range(1, 8):
-                end_row = row + direction[0] * i
-                end_column = column + direction[1] * i
-
-                if 0 <= end_row < 8 and 0 <= end_column < 8:
-                    end_piece = self.board[end_row][end_column]
+                    moves.append(square | (square + forward) << 6)
+            if row == start_row and not self.occupied & SQUARE_BITS[square + 2 * forward]:
+                if targets & SQUARE_BITS[square + 2 * forward]:
+                    moves.append(square | (square + 2 * forward) << 6 | DOUBLE_PAWN_PUSH)
+
+        attacks = PAWN_ATTACKS[color][square]
+        captures = attacks & self.occupancy[enemy_color] & targets
+        while captures:
+            bit = captures & -captures
+            if row == promotion_row:
+                for promotion in range(4):
+                    moves.append(square | (bit.bit_length() - 1) << 6 | PROMOTION | CAPTURE | promotion << 12)
+            else:
+                moves.append(square | (bit.bit_length() - 1) << 6 | CAPTURE)
+            captures ^= bit
 
-                    if end_piece == '--':
-                        moves.append(Move((row, column), (end_row, end_column), self.board))
+        if self.enpassant_square is not None and attacks & SQUARE_BITS[self.enpassant_square]:
+            moves.append(square | self.enpassant_square << 6 | ENPASSANT)
 
-                    elif end_piece[0] == enemy_color:
-                        moves.append(Move((row, column), (end_row, end_column), self.board))
-                        break
+    def get_rook_moves(self, row, column, moves, targets=FULL):
+        square = row * 8 + column
+        own = self.occupancy['w' if self.white_to_move else 'b']
+        self.add_moves(square, rook_attacks(square, self.occupied) & ~own & targets, moves)
 
-                    else:
-                        break
+    def get_knight_moves(self, row, column, moves, targets=FULL):
+        square = row * 8 + column
+        own = self.occupancy['w' if self.white_to_move else 'b']
+        self.add_moves(square, KNIGHT_ATTACKS[square] & ~own & targets, moves)
 
-                else:
-                    break
+    def get_bishop_moves(self, row, column, moves, targets=FULL):
+        square = row * 8 + column
+        own = self.occupancy['w' if self.white_to_move else 'b']
+        self.add_moves(square, bishop_attacks(square, self.occupied) & ~own & targets, moves)
 
-    def get_queen_moves(self, row, column, moves):
-        self.get_rook_moves(row, column, moves)
-        self.get_bishop_moves(row, column, moves)
+    def get_queen_moves(self, row, column, moves, targets=FULL):
+        square = row * 8 + column
+        own = self.occupancy['w' if self.white_to_move else 'b']
+        self.add_moves(square, queen_attacks(square, self.occupied) & ~own & targets, moves)
 
     def get_king_moves(self, row, column, moves):
-        king_moves = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
-        ally_color = 'w' if self.white_to_move else 'b'
-
-        for i in range(8):
-            end_row = row + king_moves[i][0]
-            end_column = column + king_moves[i][1]
+        square = row * 8 + column
+        own = self.occupancy['w' if self.white_to_move else 'b']
+        self.add_moves(square, KING_ATTACKS[square] & ~own, moves)
 
-            if 0 <= end_row < 8 and 0 <= end_column < 8:
-                end_piece = self.board[end_row][end_column]
-
-                if end_piece[0] != ally_color:
-                    moves.append(Move((row, column), (end_row, end_column), self.board))
-
-    def get_castle_moves(self, row, column, moves):
-        if self.square_under_attack(row, column):
+    def get_castle_moves(self, row, column, moves, attacked):
+        if attacked & SQUARE_BITS[row * 8 + column]:
             return
 
-        if (self.white_to_move and self.current_castling_rights.white_king_side) or (not self.white_to_move and self.current_castling_rights.black_king_side):
-            self.get_kingside_castle_moves(row, column, moves)
+        if self.castling & (WHITE_KING_SIDE if self.white_to_move else BLACK_KING_SIDE):
+            self.get_kingside_castle_moves(row, column, moves, attacked)
 
-        if (self.white_to_move and self.current_castling_rights.white_queen_side) or (not self.white_to_move and self.current_castling_rights.black_queen_side):
-            self.get_queenside_castle_moves(row, column, moves)
+        if self.castling & (WHITE_QUEEN_SIDE if self.white_to_move else BLACK_QUEEN_SIDE):
+            self.get_queenside_castle_moves(row, column, moves, attacked)
 
-    def get_kingside_castle_moves(self, row, column, moves):
-        if self.board[row][column + 1] == '--' and self.board[row][column + 2] == '--':
-            if not self.square_under_attack(row, column+1) and not self.square_under_attack(row, column+2):
-                moves.append(Move((row, column), (row, column+2), self.board, is_castle_move=True))
+    def get_kingside_castle_moves(self, row, column, moves, attacked):
+        square = row * 8 + column
+        path = SQUARE_BITS[square + 1] | SQUARE_BITS[square + 2]
+        if not self.occupied & path and not attacked & path:
+            moves.append(square | (square + 2) << 6 | KING_CASTLE)
 
-    def get_queenside_castle_moves(self, row, column, moves):
-        if self.board[row][column - 1] == '--' and self.board[row][column - 2] == '--' and self.board[row][column -3] == '--':
-            if not self.square_under_attack(row, column-1) and not self.square_under_attack(row, column-2):
-                moves.append(Move((row, column), (row, column-2), self.board, is_castle_move=True))
+    def get_queenside_castle_moves(self, row, column, moves, attacked):
+        square = row * 8 + column
+        if not self.occupied & (SQUARE_BITS[square - 1] | SQUARE_BITS[square - 2] | SQUARE_BITS[square - 3]):
+            if not attacked & (SQUARE_BITS[square - 1] | SQUARE_BITS[square - 2]):
+                moves.append(square | (square - 2) << 6 | QUEEN_CASTLE)
 
 
-class CastleRights():
-    def __init__(self, white_king_side, black_king_side, white_queen_side, black_queen_side):
-        self.white_king_side = white_king_side
-        self.black_king_side = black_king_side
-        self.white_queen_side = white_queen_side
-        self.black_queen_side = black_queen_side
+class Move:
+    __slots__ = ('code', 'piece_moved', 'piece_captured')
+
+    ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4,
+                     "5": 3, "6": 2, "7": 1, "8": 0}
+    rows_to_ranks = {v: k for k, v in ranks_to_rows.items()}
+    files_to_columns = {"a": 0, "b": 1, "c": 2, "d": 3,
+                        "e": 4, "f": 5, "g": 6, "h": 7}
+    columns_to_files = {v: k for k, v in files_to_columns.items()}
+
+    def __init__(self, start_square, end_square, board, is_enpassant_move=False, is_castle_move=False,
+                 promotion_piece='Q'):
+        start_row, start_column = start_square
+        end_row, end_column = end_square
+        self.piece_moved = board[start_row][start_column]
+        self.piece_captured = board[end_row][end_column]
+
+        flags = CAPTURE if self.piece_captured != '--' else 0
+        if self.piece_moved[1] == 'P':
+            if is_enpassant_move or (start_column != end_column and self.piece_captured == '--'):
+                flags = ENPASSANT
+                self.piece_captured = 'wP' if self.piece_moved == 'bP' else 'bP'
+            elif abs(start_row - end_row) == 2:
+                flags = DOUBLE_PAWN_PUSH
+            elif end_row == 0 or end_row == 7:
+                flags |= PROMOTION | PROMOTION_PIECES.index(promotion_piece) << 12
+        elif self.piece_moved[1] == 'K' and (is_castle_move or abs(start_column - end_column) == 2):
+            flags = KING_CASTLE if end_column > start_column else QUEEN_CASTLE
+
+        self.code = start_row * 8 + start_column | (end_row * 8 + end_column) << 6 | flags
+
+    @classmethod
+    def decode(cls, code, squares):
+        move = cls.__new__(cls)
+        move.code = code
+        move.piece_moved = squares[code & 63]
+        if code & FLAGS == ENPASSANT:
+            move.piece_captured = 'wP' if move.piece_moved == 'bP' else 'bP'
+        else:
+            move.piece_captured = squares[(code >> 6) & 63]
+        return move
 
+    @property
+    def start_row(self):
+        return (self.code & 63) >> 3
 
-class Move:
-    def __init__(self, start_square, end_square, board, is_enpassant_move=False, is_castle_move=False):
-        self.start_row = start_square[0]
-        self.start_column = start_square[1]
-        self.end_row = end_square[0]
-        self.end_column = end_square[1]
+    @property
+    def start_column(self):
+        return self.code & 7
+
+    @property
+    def end_row(self):
+        return (self.code >> 9) & 7
 
-        self.piece_moved = board[self.start_row][self.start_column]
-        self.piece_captured = board[self.end_row][self.end_column]
+    @property
+    def end_column(self):
+        return (self.code >> 6) & 7
 
-        self.ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4,
-                              "5": 3, "6": 2, "7": 1, "8": 0}
-        self.rows_to_ranks = {v: k for k, v in self.ranks_to_rows.items()}
-        self.files_to_columns = {"a": 0, "b": 1, "c": 2, "d": 3,
-                                 "e": 4, "f": 5, "g": 6, "h": 7}
-        self.columns_to_files = {v: k for k, v in self.files_to_columns.items()}
+    @property
+    def is_enpassant_move(self):
+        return self.code & FLAGS == ENPASSANT
 
-        self.is_pawn_promotion = False
-        self.is_enpassant_move = is_enpassant_move
-        self.is_castle_move = is_castle_move
+    @property
+    def is_castle_move(self):
+        return self.code & FLAGS in (KING_CASTLE, QUEEN_CASTLE)
 
-        if self.is_enpassant_move:
-            self.piece_captured = 'wP' if self.piece_moved == 'bP' else 'bP'
+    @property
+    def is_pawn_promotion(self):
+        return bool(self.code & PROMOTION)
 
-        if (self.piece_moved == 'wP' and self.end_row == 0) or (self.piece_moved == 'bP' and self.end_row == 7):
-            self.is_pawn_promotion = True
+    @property
+    def promotion_piece(self):
+        if self.code & PROMOTION:
+            return PROMOTION_PIECES[(self.code >> 12) & 3]
+        return None
 
-        self.move_id = self.start_row * 1000 + self.start_column * 100 + self.end_row * 10 + self.end_column
+    @property
+    def move_id(self):
+        return self.code
 
     def __eq__(self, other):
         if isinstance(other, Move):
-            return self.move_id == other.move_id
+            return self.code == other.code
         return False
 
+    def __hash__(self):
+        return hash(self.code)
+
     def get_chess_notation(self):
-        return self.get_rank_file(self.start_row, self.start_column) + self.get_rank_file(self.end_row, self.end_column)
+        notation = SQUARE_NAMES[self.code & 63] + SQUARE_NAMES[(self.code >> 6) & 63]
+        if self.code & PROMOTION:
+            notation += PROMOTION_PIECES[(self.code >> 12) & 3].lower()
+        return notation
 
     def get_rank_file(self, row, column):
         return self.columns_to_files[column] + self.rows_to_ranks[row]
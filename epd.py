@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import mmap
+import sys
+import time
+
+import instrument
+from engine import GameState
+
+
+def iterate_lines(path):
+    # Memory-maps the file so even multi-million-line dumps are read lazily in constant memory; falls back to
+    # buffered line iteration where mmap is unavailable (empty files, pipes, special files).
+    with open(path, 'rb') as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            mapped = None
+        if mapped is None:
+            for line in file:
+                yield line.decode('utf-8', 'replace')
+            return
+        with mapped:
+            for line in iter(mapped.readline, b''):
+                yield line.decode('utf-8', 'replace')
+
+
+def split_operations(text):
+    # Splits 'bm Nf3 Nc3; id "a; b";' into opcode/operand pairs, keeping semicolons inside quotes.
+    operations = {}
+    operation = ''
+    quoted = False
+    for char in text + ';':
+        if char == '"':
+            quoted = not quoted
+        if char == ';' and not quoted:
+            operation = operation.strip()
+            if operation:
+                opcode, _, operand = operation.partition(' ')
+                operand = operand.strip()
+                if len(operand) > 1 and operand[0] == operand[-1] == '"':
+                    operand = operand[1:-1]
+                operations[opcode] = operand
+            operation = ''
+        else:
+            operation += char
+    return operations
+
+
+def parse_line(line):
+    # Accepts both EPD records (four position fields followed by operations) and plain FEN lines. Returns None for
+    # blank lines and comments.
+    line = line.strip()
+    if not line or line[0] == '#':
+        return None
+
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError(f'Invalid EPD record: {line!r}')
+    rest = fields[4] if len(fields) > 4 else ''
+    clocks = rest.split(None, 2)
+    if len(clocks) >= 2 and clocks[0].isdigit() and clocks[1].isdigit():
+        fen = ' '.join(fields[:4] + clocks[:2])
+        rest = clocks[2] if len(clocks) > 2 else ''
+        operations = split_operations(rest)
+    else:
+        operations = split_operations(rest)
+        fen = ' '.join(fields[:4] + [operations.get('hmvc', '0'), operations.get('fmvn', '1')])
+    return fen, operations
+
+
+def numbered_records(path):
+    # (line number, fen, operations) for each record; parse errors name the file and line.
+    for number, line in enumerate(iterate_lines(path), 1):
+        try:
+            record = parse_line(line)
+        except ValueError as error:
+            raise ValueError(f'{path}:{number}: {error}') from None
+        if record is not None:
+            yield (number,) + record
+
+
+def read_records(path):
+    for _, fen, operations in numbered_records(path):
+        yield fen, operations
+
+
+def read_positions(path):
+    for number, fen, operations in numbered_records(path):
+        try:
+            game_state = GameState.from_fen(fen)
+        except ValueError as error:
+            raise ValueError(f'{path}:{number}: {error}') from None
+        yield game_state, operations
+
+
+def to_epd(game_state, operations=None):
+    fields = game_state.to_fen().split()[:4]
+    operations = dict(operations or {})
+    if game_state.halfmove_clock or game_state.fullmove_number != 1:
+        operations.setdefault('hmvc', str(game_state.halfmove_clock))
+        operations.setdefault('fmvn', str(game_state.fullmove_number))
+    for opcode, operand in operations.items():
+        if ' ' in operand or ';' in operand:
+            operand = f'"{operand}"'
+        fields.append(f'{opcode} {operand};' if operand else f'{opcode};')
+    return ' '.join(fields)
+
+
+def write_epd(path, records):
+    # records yields (game_state, operations) pairs, so read_positions output can be filtered and written back.
+    count = 0
+    with open(path, 'w') as file:
+        for game_state, operations in records:
+            file.write(to_epd(game_state, operations) + '\n')
+            count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream positions from an EPD or FEN file.')
+    parser.add_argument('path')
+    parser.add_argument('--print', action='store_true', help='print each position as FEN')
+    parser.add_argument('--profile', nargs='?', const='epd.prof', metavar='PATH',
+                        help='instrument the engine and write pstats-compatible stats to PATH')
+    args = parser.parse_args(argv)
+
+    with instrument.profiling(args.profile):
+        start = time.perf_counter()
+        count = 0
+        try:
+            for game_state, operations in read_positions(args.path):
+                count += 1
+                if args.print:
+                    print(game_state.to_fen(), operations or '')
+        except (OSError, ValueError) as error:
+            print(f'error: {error}', file=sys.stderr)
+            return 1
+        elapsed = time.perf_counter() - start
+        print(f'positions: {count}  time: {elapsed:.3f}s  rate: {count / max(elapsed, 1e-9):.0f}/s', file=sys.stderr)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
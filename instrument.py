@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import functools
+import marshal
+import sys
+import threading
+import time
+
+from engine import GameState
+
+# Nothing here touches GameState until enable() swaps these methods for counting/timing wrappers, and disable()
+# puts the originals back, so the engine runs unmodified code whenever profiling is off.
+METHODS = (
+    'make_move', 'undo_move', 'get_valid_moves', 'get_valid_move_codes', 'get_possible_moves',
+    'get_possible_move_codes', 'get_pawn_moves', 'get_rook_moves', 'get_knight_moves', 'get_bishop_moves',
+    'get_queen_moves', 'get_king_moves', 'get_castle_moves', 'get_attack_map', 'get_pins', 'in_check',
+    'square_under_attack',
+)
+
+_originals = {}
+_records = {}
+_callers = {}
+_keys = {}
+_local = threading.local()
+
+
+def _wrap(name, function):
+    record = _records.setdefault(name, [0, 0.0, 0.0])
+    _keys[name] = (function.__code__.co_filename, function.__code__.co_firstlineno, name)
+    perf_counter = time.perf_counter
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        caller = stack[-1] if stack else None
+        frame = [name, 0.0]
+        stack.append(frame)
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            stack.pop()
+            record[0] += 1
+            record[1] += elapsed
+            record[2] += elapsed - frame[1]
+            if caller is not None:
+                caller[1] += elapsed
+                link = _callers.setdefault((caller[0], name), [0, 0.0, 0.0])
+                link[0] += 1
+                link[1] += elapsed
+                link[2] += elapsed - frame[1]
+
+    return wrapper
+
+
+def _rebind(game_state):
+    for piece, generator in game_state.move_mapping.items():
+        game_state.move_mapping[piece] = getattr(game_state, generator.__name__)
+
+
+def enable(game_states=()):
+    # GameState objects created before enable() keep bound generators in move_mapping; pass them to rebind.
+    if not _originals:
+        for name in METHODS:
+            function = GameState.__dict__.get(name)
+            if function is not None:
+                _originals[name] = function
+                setattr(GameState, name, _wrap(name, function))
+    for game_state in game_states:
+        _rebind(game_state)
+
+
+def disable(game_states=()):
+    for name, function in _originals.items():
+        setattr(GameState, name, function)
+    _originals.clear()
+    for game_state in game_states:
+        _rebind(game_state)
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def reset():
+    for record in list(_records.values()) + list(_callers.values()):
+        record[:] = [0, 0.0, 0.0]
+
+
+def get_stats():
+    # name -> calls, inclusive (total) and exclusive (self) seconds, and share of all instrumented self time.
+    self_time = sum(record[2] for record in _records.values()) or 1.0
+    return {
+        name: {
+            'calls': calls,
+            'total': total,
+            'self': own,
+            'per_call': total / calls if calls else 0.0,
+            'share': own / self_time,
+        }
+        for name, (calls, total, own) in sorted(_records.items(), key=lambda item: -item[1][2]) if calls
+    }
+
+
+def dump_stats(path):
+    # Writes the same marshal layout cProfile uses, so pstats.Stats(path) and tools such as snakeviz can read it.
+    stats = {}
+    for name, (calls, total, own) in _records.items():
+        if calls:
+            callers = {_keys[caller]: (count, count, own_time, total_time)
+                       for (caller, callee), (count, total_time, own_time) in _callers.items() if callee == name}
+            stats[_keys[name]] = (calls, calls, own, total, callers)
+    with open(path, 'wb') as file:
+        marshal.dump(stats, file)
+
+
+def print_stats(out=sys.stderr):
+    print(f'{"function":<26}{"calls":>12}{"total s":>11}{"self s":>11}{"us/call":>10}{"share":>8}', file=out)
+    for name, stats in get_stats().items():
+        print(f'{name:<26}{stats["calls"]:>12}{stats["total"]:>11.3f}{stats["self"]:>11.3f}'
+              f'{stats["per_call"] * 1e6:>10.2f}{stats["share"]:>8.1%}', file=out)
+
+
+def report(path=None, out=sys.stderr):
+    print_stats(out)
+    if path:
+        dump_stats(path)
+        print(f'profile written to {path} (load with pstats.Stats)', file=out)
+
+
+@contextlib.contextmanager
+def profiling(path):
+    # Used by the --profile flag of the entry points; a falsy path leaves the engine uninstrumented.
+    if not path:
+        yield
+        return
+    enable()
+    try:
+        yield
+    finally:
+        disable()
+        report(path)
@@ -1,89 +1,206 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pygame
 import engine
-import math
+import instrument
 
 WIDTH = HEIGHT = 512
 DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15
 LOG_MOVES = True
+HUMAN_WHITE = True
+HUMAN_BLACK = True
+SEARCH_TIME = 1.0
+BOOK_PATH = None
+TABLEBASE_PATH = None
 IMAGES = {}
+COLORS = [pygame.Color('white'), (119, 148, 85)]
+ENGINE_DONE = pygame.USEREVENT + 1
 
 
-def load_images():
-    pieces = ['wP', 'wR', 'wN', 'wB', 'wK', 'wQ', 'bP', 'bR', 'bN', 'bB', 'bK', 'bQ']
-    for piece in pieces:
-        IMAGES[piece] = pygame.transform.scale(pygame.image.load(f'images/{piece}.png'), (SQ_SIZE, SQ_SIZE))
-
-
-def draw_board(screen):
-    global colors
-    colors = [pygame.Color('white'), (119, 148, 85)]
-
-    for row in range(DIMENSION):
-        for column in range(DIMENSION):
-            color = colors[((row + column) % 2)]
-            pygame.draw.rect(screen, color, pygame.Rect(column * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
+def get_image(piece):
+    # Sprites are decoded and scaled on first draw rather than all up front, so the window opens sooner.
+    image = IMAGES.get(piece)
+    if image is None:
+        image = IMAGES[piece] = pygame.transform.scale(pygame.image.load(f'images/{piece}.png'), (SQ_SIZE, SQ_SIZE))
+    return image
 
 
-def draw_pieces(screen, board):
-    for row in range(DIMENSION):
-        for column in range(DIMENSION):
-            piece = board[row][column]
-            if piece != '--':
-                screen.blit(IMAGES[piece], pygame.Rect(column * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
+def square_rect(row, column):
+    return pygame.Rect(column * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
 
 
-def highlight_squares(screen, game_state, valid_moves, selected_square):
+def get_highlights(game_state, valid_moves, selected_square):
+    highlights = {}
     if selected_square != ():
         row, column = selected_square
 
         if game_state.board[row][column][0] == ('w' if game_state.white_to_move else 'b'):
-            shape = pygame.Surface((SQ_SIZE, SQ_SIZE))
-            shape.set_alpha(100)
-            shape.fill(pygame.Color('blue'))
-            screen.blit(shape, (column * SQ_SIZE, row * SQ_SIZE))
+            highlights[row * DIMENSION + column] = 'blue'
 
             for move in valid_moves:
                 if move.start_row == row and move.start_column == column:
                     if game_state.board[move.end_row][move.end_column] != '--':
-                        shape.fill(pygame.Color('red'))
-                        screen.blit(shape, (move.end_column * SQ_SIZE, move.end_row * SQ_SIZE))
+                        highlights[move.end_row * DIMENSION + move.end_column] = 'red'
                     else:
-                        shape.fill(pygame.Color('yellow'))
-                        screen.blit(shape, (move.end_column * SQ_SIZE, move.end_row * SQ_SIZE))
-
-
-def draw_game_state(screen, game_state, valid_moves, selected_square):
-    draw_board(screen)
-    highlight_squares(screen, game_state, valid_moves, selected_square)
-    draw_pieces(screen, game_state.board)
-
-
-def animate_move(move, screen, board, clock):
-    global colors
-    delta_row = move.end_row - move.start_row
-    delta_column = move.end_column - move.start_column
-    frames_per_square = round(math.sqrt(abs(delta_row) ** 2 + abs(delta_column) ** 2))
-    frames_per_square = (frames_per_square + (round(DIMENSION / 2) - frames_per_square) * 2) if (frames_per_square + (round(DIMENSION / 2) - frames_per_square) * 2) > 0 else 1
-    frame_count = (abs(delta_row) + abs(delta_column)) * frames_per_square
-
-    for frame in range(frame_count + 1):
-        row, column = (move.start_row + delta_row * frame / frame_count, move.start_column + delta_column * frame / frame_count)
-        draw_board(screen)
-        draw_pieces(screen, board)
-        color = colors[(move.end_row + move.end_column) % 2]
-        end_square = pygame.Rect(move.end_column * SQ_SIZE, move.end_row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
-        pygame.draw.rect(screen, color, end_square)
-
-        if move.piece_captured != '--':
-            screen.blit(IMAGES[move.piece_captured], end_square)
-
-        screen.blit(IMAGES[move.piece_moved], pygame.Rect(column * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        pygame.display.flip()
-        clock.tick(60)
+                        highlights[move.end_row * DIMENSION + move.end_column] = 'yellow'
+    return highlights
+
+
+class Renderer:
+    # Keeps a pre-rendered board and the piece/highlight last drawn on every square, so a frame only repaints
+    # the squares that changed and hands just those rectangles to pygame.display.update.
+    def __init__(self, screen):
+        self.screen = screen
+        self.background = pygame.Surface((WIDTH, HEIGHT))
+        for row in range(DIMENSION):
+            for column in range(DIMENSION):
+                self.background.fill(COLORS[(row + column) % 2], square_rect(row, column))
+
+        self.overlays = {}
+        for color in ('blue', 'red', 'yellow'):
+            overlay = pygame.Surface((SQ_SIZE, SQ_SIZE))
+            overlay.set_alpha(100)
+            overlay.fill(pygame.Color(color))
+            self.overlays[color] = overlay
+        self.drawn = [None] * (DIMENSION * DIMENSION)
+
+        self.indicator = pygame.font.Font(None, 24).render(' Thinking... ', True, pygame.Color('white'),
+                                                             pygame.Color('black'))
+        self.indicator_rect = self.indicator.get_rect(topright=(WIDTH - 4, 4))
+        self.indicator_squares = [square for square in range(DIMENSION * DIMENSION)
+                                  if square_rect(*divmod(square, DIMENSION)).colliderect(self.indicator_rect)]
+        self.thinking = False
+
+    def invalidate(self):
+        self.drawn = [None] * (DIMENSION * DIMENSION)
+
+    def draw_square(self, square, piece, highlight):
+        rect = square_rect(square // DIMENSION, square % DIMENSION)
+        self.screen.blit(self.background, rect, rect)
+        if highlight is not None:
+            self.screen.blit(self.overlays[highlight], rect)
+        if piece != '--':
+            self.screen.blit(get_image(piece), rect)
+        return rect
+
+    def render(self, game_state, valid_moves, selected_square):
+        highlights = get_highlights(game_state, valid_moves, selected_square)
+        dirty = []
+        for square, piece in enumerate(game_state.squares):
+            state = (piece, highlights.get(square))
+            if self.drawn[square] != state:
+                self.drawn[square] = state
+                dirty.append(self.draw_square(square, *state))
+        return dirty
+
+    def draw(self, game_state, valid_moves, selected_square, thinking=False):
+        dirty = self.render(game_state, valid_moves, selected_square)
+        # Squares under the indicator are repainted whenever it is shown, hidden or drawn over.
+        if thinking != self.thinking or (thinking and any(rect.colliderect(self.indicator_rect) for rect in dirty)):
+            self.thinking = thinking
+            for square in self.indicator_squares:
+                dirty.append(self.draw_square(square, *self.drawn[square]))
+            if thinking:
+                self.screen.blit(self.indicator, self.indicator_rect)
+        if dirty:
+            pygame.display.update(dirty)
+
+    def animate_move(self, move, game_state, clock):
+        # Renders the position after the move, puts the captured piece back under the destination and slides the
+        # moving sprite over it, repainting only the two rectangles the sprite leaves and enters each frame.
+        delta_row = move.end_row - move.start_row
+        delta_column = move.end_column - move.start_column
+        frames_per_square = round(math.sqrt(abs(delta_row) ** 2 + abs(delta_column) ** 2))
+        frames_per_square = (frames_per_square + (round(DIMENSION / 2) - frames_per_square) * 2) if (frames_per_square + (round(DIMENSION / 2) - frames_per_square) * 2) > 0 else 1
+        frame_count = (abs(delta_row) + abs(delta_column)) * frames_per_square
+
+        dirty = self.render(game_state, [], ())
+        end_square = move.end_row * DIMENSION + move.end_column
+        dirty.append(self.draw_square(end_square, move.piece_captured, None))
+        self.drawn[end_square] = None
+        base = self.screen.copy()
+
+        previous = square_rect(move.start_row, move.start_column)
+        for frame in range(frame_count + 1):
+            row, column = (move.start_row + delta_row * frame / frame_count, move.start_column + delta_column * frame / frame_count)
+            rect = pygame.Rect(column * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+            self.screen.blit(base, previous, previous)
+            self.screen.blit(get_image(move.piece_moved), rect)
+            pygame.display.update(dirty + [previous, rect])
+            dirty = []
+            previous = rect
+            clock.tick(60)
+
+
+class EngineWorker:
+    # Runs engine work on a background thread and reports back with ENGINE_DONE events. Each job is tagged with
+    # the generation it was started in, so results that arrive after an undo or reset are recognised as stale.
+    # The thread owns one long-lived GameState that jobs bring up to date with the GUI's move list, so its move
+    # cache survives undo/redo browsing and searches see the whole game for repetitions.
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.game_state = engine.GameState()
+        self.generation = 0
+        self.pending = 0
+        self.stop_event = threading.Event()
+
+    def submit(self, kind, function, *args):
+        generation = self.generation
+        self.pending += 1
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda done: pygame.event.post(
+            pygame.event.Event(ENGINE_DONE, kind=kind, generation=generation, future=done)))
+
+    def finished(self, event):
+        self.pending -= 1
+        return event.generation == self.generation
+
+    def cancel(self):
+        self.generation += 1
+        self.stop_event.set()
+        self.stop_event = threading.Event()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def sync(game_state, codes):
+    # Undoes the worker's GameState back to the longest common prefix with the GUI's moves, then replays the rest.
+    # codes is a copy taken on the GUI thread, so the GUI can keep undoing and resetting while the job runs.
+    move_log = game_state.move_log
+    common = 0
+    while common < len(move_log) and common < len(codes) and move_log[common] == codes[common]:
+        common += 1
+    while len(move_log) > common:
+        game_state.undo_move()
+    for code in codes[common:]:
+        game_state.make_move(code)
+    return game_state
+
+
+def compute_moves(game_state, codes):
+    sync(game_state, codes)
+    moves = game_state.get_valid_moves()
+    return moves, game_state.checkmate, game_state.stalemate
+
+
+def compute_best_move(game_state, codes, tt, stop_event, book=None, tablebase=None):
+    import search
+    sync(game_state, codes)
+    # choose() only returns moves that are legal here, so a broken book entry falls through to the search.
+    code = book.choose(game_state) if book is not None else None
+    if code is not None:
+        return game_state.decode_move(code)
+    return search.search(game_state, search.SearchLimits(movetime=SEARCH_TIME), tt, stop_event,
+                         tablebase=tablebase).best_move
 
 
 def main():
@@ -92,24 +209,83 @@ def main():
     screen = pygame.display.set_mode((WIDTH, HEIGHT))
     clock = pygame.time.Clock()
 
-    screen.fill(pygame.Color('white'))
-
+    renderer = Renderer(screen)
+    # Pointer motion is never drawn, so it should not wake the loop either.
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+
+    worker = EngineWorker()
+    # The search, its table, the book and the tablebases are only loaded when the engine plays a side.
+    tt = book = tablebase = None
+    if not (HUMAN_WHITE and HUMAN_BLACK):
+        from tt import TranspositionTable
+        tt = TranspositionTable()
+        if BOOK_PATH:
+            from book import OpeningBook
+            book = OpeningBook(BOOK_PATH)
+        if TABLEBASE_PATH:
+            from tablebase import Tablebase
+            tablebase = Tablebase(TABLEBASE_PATH)
     game_state = engine.GameState()
-    valid_moves = game_state.get_valid_moves()
+    # Move lists and engine replies are computed off the event loop; clicks simply find no legal move until the
+    # list for the current position arrives.
+    worker.submit('moves', compute_moves, worker.game_state, list(game_state.move_log))
+    valid_moves = []
     move_made = False
-    load_images()
     running = True
     selected_square = ()
     player_clicks = []
     game_over = False
 
+    renderer.draw(game_state, valid_moves, selected_square, worker.pending > 0)
     while running:
-        for event in pygame.event.get():
+        human_turn = HUMAN_WHITE if game_state.white_to_move else HUMAN_BLACK
+
+        # Block until something happens, so an idle board costs no CPU.
+        for event in [pygame.event.wait()] + pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
 
+            elif event.type == ENGINE_DONE:
+                if not worker.finished(event) or event.future.cancelled():
+                    continue
+
+                if event.kind == 'moves':
+                    valid_moves, checkmate, stalemate = event.future.result()
+                    if checkmate:
+                        game_over = True
+                        if game_state.white_to_move:
+                            print('Black wins by checkmate')
+                        else:
+                            print('White wins by checkmate')
+
+                    elif stalemate:
+                        game_over = True
+                        print('Stalemate')
+
+                    elif game_state.get_draw_reason() is not None:
+                        game_over = True
+                        print(f'Draw by {game_state.get_draw_reason()}')
+
+                    elif not human_turn:
+                        worker.submit('search', compute_best_move, worker.game_state, list(game_state.move_log), tt,
+                                      worker.stop_event, book, tablebase)
+
+                elif event.kind == 'search':
+                    best_move = event.future.result()
+                    for move in valid_moves:
+                        if best_move is not None and move == best_move:
+                            if LOG_MOVES:
+                                print(f'ENGINE: {move.get_chess_notation()}')
+
+                            game_state.make_move(move)
+                            last_move = move
+                            move_made = True
+
+            elif event.type == pygame.VIDEOEXPOSE:
+                renderer.invalidate()
+
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                if not game_over:
+                if not game_over and human_turn:
                     location = pygame.mouse.get_pos()
                     column = location[0] // SQ_SIZE
                     row = location[1] // SQ_SIZE
@@ -137,6 +313,7 @@ def main():
                                     print(f'MOVED: {move.get_chess_notation()}')
 
                                 game_state.make_move(valid_moves[i])
+                                last_move = valid_moves[i]
                                 move_made = True
                                 selected_square = ()
                                 player_clicks = []
@@ -146,44 +323,46 @@ def main():
 
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_z:
+                    worker.cancel()
                     game_state.undo_move()
-                    valid_moves = game_state.get_valid_moves()
+                    valid_moves = []
+                    worker.submit('moves', compute_moves, worker.game_state, list(game_state.move_log))
+                    selected_square = ()
+                    player_clicks = []
                     move_made = False
+                    game_over = False
 
                 elif event.key == pygame.K_s:
                     pygame.image.save(screen, 'capture.jpeg')
                     print('Captured screen.')
 
                 elif event.key == pygame.K_r:
+                    worker.cancel()
                     game_state = engine.GameState()
-                    valid_moves = game_state.get_valid_moves()
+                    valid_moves = []
+                    worker.submit('moves', compute_moves, worker.game_state, list(game_state.move_log))
                     selected_square = ()
                     player_clicks = []
                     move_made = False
+                    game_over = False
 
         if move_made:
-            if not game_state.move_log[-1].is_enpassant_move and not game_state.move_log[-1].is_castle_move:
-                animate_move(game_state.move_log[-1], screen, game_state.board, clock)
-
-            valid_moves = game_state.get_valid_moves()
-
-            if game_state.checkmate:
-                game_over = True
-                if game_state.white_to_move:
-                    print('Black wins by checkmate')
-                else:
-                    print('White wins by checkmate')
-
-            elif game_state.stalemate:
-                game_over = True
-                print('Stalemate')
+            if not last_move.is_enpassant_move and not last_move.is_castle_move:
+                renderer.animate_move(last_move, game_state, clock)
 
+            valid_moves = []
+            worker.submit('moves', compute_moves, worker.game_state, list(game_state.move_log))
             move_made = False
 
-        draw_game_state(screen, game_state, valid_moves, selected_square)
+        renderer.draw(game_state, valid_moves, selected_square, worker.pending > 0)
         clock.tick(MAX_FPS)
-        pygame.display.flip()
+
+    worker.shutdown()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Play chess in a pygame window.')
+    parser.add_argument('--profile', nargs='?', const='gui.prof', metavar='PATH',
+                        help='instrument the engine and write pstats-compatible stats to PATH on exit')
+    with instrument.profiling(parser.parse_args().profile):
+        main()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import math
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from book import read_corpus, resolve
+from engine import START_FEN, GameState
+from epd import read_records
+from uci import move_notation
+
+# Each opening is played twice with colours swapped. Engines run as UCI subprocesses, so a configuration can
+# point at another checkout of the repository (path=...) and two commits can be played against each other.
+OPENINGS = (
+    'e2e4 e7e5 g1f3 b8c6 f1b5',
+    'e2e4 c7c5 g1f3 d7d6 d2d4',
+    'e2e4 e7e6 d2d4 d7d5',
+    'e2e4 c7c6 d2d4 d7d5',
+    'd2d4 d7d5 c2c4 e7e6',
+    'd2d4 g8f6 c2c4 g7g6',
+    'c2c4 e7e5 b1c3 g8f6',
+    'g1f3 d7d5 g2g3 g8f6',
+)
+MAX_PLIES = 400
+TIME_MARGIN = 0.2
+READY_TIMEOUT = 30.0
+
+
+class EngineError(Exception):
+    pass
+
+
+def parse_engine(text):
+    # 'name=new,path=../other,Hash=32': name and path (a checkout holding uci.py) or cmd (any UCI command line);
+    # depth, nodes and movetime override the match limits for this engine; every other key is a UCI option.
+    config = {'name': None, 'path': '.', 'cmd': None, 'options': {}, 'limits': {}}
+    for item in filter(None, text.split(',')):
+        key, _, value = item.partition('=')
+        if key in ('name', 'path', 'cmd'):
+            config[key] = value
+        elif key in ('depth', 'nodes'):
+            config['limits'][key] = int(value)
+        elif key == 'movetime':
+            config['limits'][key] = float(value)
+        else:
+            config['options'][key] = value
+    config['name'] = config['name'] or os.path.basename(os.path.abspath(config['path']))
+    return config
+
+
+def parse_time_control(text):
+    # 'base+increment' in seconds, e.g. '10+0.1'.
+    base, _, increment = text.partition('+')
+    return float(base), float(increment or 0)
+
+
+def revision(path):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=path, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class UCIProcess:
+    def __init__(self, config):
+        self.config = config
+        command = shlex.split(config['cmd']) if config['cmd'] else [sys.executable, 'uci.py']
+        try:
+            self.process = subprocess.Popen(command, cwd=config['path'], stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        except OSError as error:
+            raise EngineError(f'cannot start: {error}') from None
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        for line in self.process.stdout:
+            self.lines.put(line.strip())
+        self.lines.put(None)
+
+    def send(self, line):
+        try:
+            self.process.stdin.write(line + '\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise EngineError('engine exited') from None
+
+    def wait_for(self, prefix, timeout):
+        # Returns the lines read up to and including the first starting with prefix.
+        deadline = time.perf_counter() + timeout
+        lines = []
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                raise EngineError(f'no {prefix!r} within {timeout:.1f}s') from None
+            if line is None:
+                raise EngineError('engine exited')
+            lines.append(line)
+            if line.startswith(prefix):
+                return lines
+
+    def start(self):
+        self.send('uci')
+        self.wait_for('uciok', READY_TIMEOUT)
+        for name, value in self.config['options'].items():
+            self.send(f'setoption name {name} value {value}')
+        self.new_game()
+
+    def new_game(self):
+        self.send('ucinewgame')
+        self.send('isready')
+        self.wait_for('readyok', READY_TIMEOUT)
+
+    def go(self, position, arguments, timeout):
+        # Returns (move, nodes, seconds) for one search; nodes come from the last info line that reported them.
+        self.send(position)
+        start = time.perf_counter()
+        self.send('go ' + arguments)
+        lines = self.wait_for('bestmove', timeout)
+        elapsed = time.perf_counter() - start
+        nodes = 0
+        for line in lines:
+            tokens = line.split()
+            if tokens[0] == 'info' and 'nodes' in tokens and tokens.index('nodes') + 1 < len(tokens):
+                nodes = int(tokens[tokens.index('nodes') + 1])
+        tokens = lines[-1].split()
+        return (tokens[1] if len(tokens) > 1 else '0000'), nodes, elapsed
+
+    def close(self):
+        try:
+            self.send('quit')
+            self.process.wait(timeout=5)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+def load_openings(path):
+    # (start FEN, move codes) pairs from an EPD file, a PGN file or a move-list file; the built-in suite if no path.
+    if path is None:
+        corpus = ((START_FEN, line.split(), '*') for line in OPENINGS)
+    elif path.endswith('.epd'):
+        return [(fen, []) for fen, _ in read_records(path)]
+    else:
+        corpus = read_corpus(path)
+    openings = []
+    for fen, tokens, _ in corpus:
+        game_state = GameState.from_fen(fen)
+        codes = []
+        for token in tokens:
+            code = resolve(game_state, token)
+            game_state.make_move(code)
+            codes.append(code)
+        openings.append((fen, codes))
+    return openings
+
+
+def play_game(opening, white, black, match_limits):
+    # Plays one game and returns a record with the result from white's point of view, the reason, and per-side
+    # move counts, nodes and thinking time. A side that crashes, stalls, plays an illegal move or overruns its
+    # clock loses.
+    fen, codes = opening
+    game_state = GameState.from_fen(fen)
+    for code in codes:
+        game_state.make_move(code)
+    engines = {}
+    stats = {'w': [0, 0, 0.0], 'b': [0, 0, 0.0]}
+    clocks = {'w': match_limits['time'], 'b': match_limits['time']}
+    result = reason = None
+    moves = [move_notation(code) for code in codes]
+    try:
+        for side, config in (('w', white), ('b', black)):
+            try:
+                engines[side] = UCIProcess(config)
+                engines[side].start()
+            except EngineError as error:
+                result, reason = ('0-1' if side == 'w' else '1-0'), f'{side} {error}'
+                break
+
+        while result is None:
+            status = game_state.get_game_status()
+            if status is not None:
+                if status == 'checkmate':
+                    result = '0-1' if game_state.white_to_move else '1-0'
+                else:
+                    result = '1/2-1/2'
+                reason = status
+                break
+            if len(moves) >= match_limits['max_plies']:
+                result, reason = '1/2-1/2', 'move limit'
+                break
+
+            side = 'w' if game_state.white_to_move else 'b'
+            limits = match_limits
+            if (white if side == 'w' else black)['limits']:
+                limits = dict(match_limits, time=None, movetime=None, depth=None, nodes=None)
+                limits.update((white if side == 'w' else black)['limits'])
+            if limits['time'] is not None:
+                arguments = (f"wtime {int(clocks['w'] * 1000)} btime {int(clocks['b'] * 1000)} "
+                             f"winc {int(limits['increment'] * 1000)} binc {int(limits['increment'] * 1000)}")
+                timeout = clocks[side] + TIME_MARGIN
+            elif limits['movetime'] is not None:
+                arguments = f"movetime {int(limits['movetime'] * 1000)}"
+                timeout = limits['movetime'] + TIME_MARGIN
+            else:
+                arguments = ' '.join(f'{key} {limits[key]}' for key in ('depth', 'nodes') if limits[key] is not None)
+                timeout = limits['timeout']
+            position = f'position fen {fen}' + (' moves ' + ' '.join(moves) if moves else '')
+
+            try:
+                notation, nodes, elapsed = engines[side].go(position, arguments, timeout)
+            except EngineError as error:
+                result, reason = ('0-1' if side == 'w' else '1-0'), f'{side} {error}'
+                break
+            record = stats[side]
+            record[0] += 1
+            record[1] += nodes
+            record[2] += elapsed
+            if limits['time'] is not None:
+                clocks[side] -= elapsed
+                if clocks[side] < -TIME_MARGIN:
+                    result, reason = ('0-1' if side == 'w' else '1-0'), f'{side} lost on time'
+                    break
+                clocks[side] += limits['increment']
+
+            legal = {move_notation(code): code for code in game_state.get_valid_move_codes()}
+            if notation not in legal:
+                result, reason = ('0-1' if side == 'w' else '1-0'), f'{side} illegal move {notation}'
+                break
+            game_state.make_move(legal[notation])
+            moves.append(notation)
+    finally:
+        for engine in engines.values():
+            engine.close()
+
+    return {'fen': fen, 'opening': moves[:len(codes)], 'white': white['name'], 'black': black['name'],
+            'result': result, 'reason': reason, 'plies': len(moves) - len(codes),
+            'stats': {white['name'] if side == 'w' else black['name']: record for side, record in stats.items()}}
+
+
+def elo_stats(wins, draws, losses):
+    # Elo difference with a 95% interval from the per-game score variance, and the likelihood of superiority.
+    games = wins + draws + losses
+    if not games:
+        return None
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    error = 1.96 * math.sqrt(variance / games)
+
+    def elo(fraction):
+        fraction = min(max(fraction, 1e-6), 1 - 1e-6)
+        return -400 * math.log10(1 / fraction - 1) + 0.0
+
+    decisive = wins + losses
+    los = 0.5 * (1 + math.erf((wins - losses) / math.sqrt(2 * decisive))) if decisive else 0.5
+    return {'score': score, 'elo': elo(score), 'elo_low': elo(score - error), 'elo_high': elo(score + error),
+            'los': los}
+
+
+def summarize(games, first, second):
+    wins = draws = losses = 0
+    engines = {config['name']: {'moves': 0, 'nodes': 0, 'time': 0.0} for config in (first, second)}
+    for game in games:
+        if game['result'] == '1/2-1/2':
+            draws += 1
+        elif (game['result'] == '1-0') == (game['white'] == first['name']):
+            wins += 1
+        else:
+            losses += 1
+        for name, (moves, nodes, elapsed) in game['stats'].items():
+            engines[name]['moves'] += moves
+            engines[name]['nodes'] += nodes
+            engines[name]['time'] += elapsed
+    for stats in engines.values():
+        stats['nps'] = int(stats['nodes'] / stats['time']) if stats['time'] else 0
+        stats['time_per_move'] = stats['time'] / stats['moves'] if stats['moves'] else 0.0
+    return {'wins': wins, 'draws': draws, 'losses': losses, 'elo': elo_stats(wins, draws, losses),
+            'engines': engines}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play two engine configurations against each other.')
+    parser.add_argument('--engine', action='append', required=True, metavar='SPEC',
+                        help="name=NAME,path=CHECKOUT or cmd=COMMAND, plus UCI options such as Hash=32 (twice)")
+    parser.add_argument('--openings', help='EPD, PGN or move-list file (default: built-in suite)')
+    parser.add_argument('--rounds', type=int, default=1, help='times to play through the suite')
+    parser.add_argument('--tc', help="clock as 'base+increment' seconds, e.g. 10+0.1")
+    parser.add_argument('--movetime', type=float, help='fixed seconds per move')
+    parser.add_argument('--depth', type=int)
+    parser.add_argument('--nodes', type=int)
+    parser.add_argument('--max-plies', type=int, default=MAX_PLIES, help='adjudicate a draw after this many plies')
+    parser.add_argument('--concurrency', type=int, default=max((os.cpu_count() or 2) // 2, 1),
+                        help='games played at once')
+    parser.add_argument('--output', default='match.json')
+    args = parser.parse_args(argv)
+    if len(args.engine) != 2:
+        parser.error('exactly two --engine specs are needed')
+    first, second = map(parse_engine, args.engine)
+    if first['name'] == second['name']:
+        second['name'] += '-2'
+
+    base, increment = parse_time_control(args.tc) if args.tc else (None, 0.0)
+    movetime = args.movetime if args.movetime is not None or args.tc or args.depth or args.nodes else 0.1
+    limits = {'time': base, 'increment': increment, 'movetime': movetime, 'depth': args.depth,
+              'nodes': args.nodes, 'max_plies': args.max_plies, 'timeout': 600.0}
+
+    openings = load_openings(args.openings) * args.rounds
+    if not openings:
+        parser.error('no openings to play')
+    start = time.perf_counter()
+    games = []
+    with ProcessPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = []
+        for opening in openings:
+            futures.append(executor.submit(play_game, opening, first, second, limits))
+            futures.append(executor.submit(play_game, opening, second, first, limits))
+        for future in as_completed(futures):
+            game = future.result()
+            games.append(game)
+            print(f"{len(games):>4}/{len(futures)}  {game['white']} - {game['black']}  {game['result']}  "
+                  f"({game['reason']}, {game['plies']} plies)", flush=True)
+
+    summary = summarize(games, first, second)
+    elo = summary['elo']
+    print(f"{first['name']} vs {second['name']}: +{summary['wins']} ={summary['draws']} -{summary['losses']}  "
+          f"Elo {elo['elo']:+.1f} [{elo['elo_low']:+.1f}, {elo['elo_high']:+.1f}]  LOS {elo['los']:.1%}")
+    for name, stats in summary['engines'].items():
+        print(f"{name:<16} {stats['nps']:>9} nps  {stats['time_per_move'] * 1000:8.1f} ms/move  "
+              f"{stats['moves']} moves")
+
+    report = dict(summary, timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), elapsed=time.perf_counter() - start,
+                  limits=limits, configs=[dict(config, revision=revision(config['path'])) for config in (first, second)],
+                  games=games)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'results written to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
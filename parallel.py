@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import engine
+import perft
+import search
+from snapshot import decode, encode
+from tt import TranspositionTable
+
+# Workers receive a FEN string (perft) or a game snapshot (search, so repetitions are seen) and packed move codes
+# rather than pickled GameState objects. Each search worker keeps one transposition table across tasks.
+_worker_tt = None
+
+
+def perft_task(fen, code, depth):
+    game_state = engine.GameState.from_fen(fen)
+    game_state.make_move(code)
+    return code, perft.perft(game_state, depth - 1)
+
+
+def search_task(data, code, depth, movetime, nodes):
+    global _worker_tt
+    if _worker_tt is None:
+        _worker_tt = TranspositionTable()
+    game_state = decode(data)
+    game_state.make_move(code)
+    if depth is not None and depth <= 1:
+        searcher = search.Searcher(game_state, search.SearchLimits(), _worker_tt)
+        score = searcher.quiescence(-search.INFINITY, search.INFINITY, 1)
+        return code, -score, [], searcher.nodes, 1
+
+    # A forced reply must not end the child search early, or forcing root moves are compared at a shallower depth.
+    limits = search.SearchLimits(depth=depth - 1 if depth is not None else None, movetime=movetime, nodes=nodes,
+                                 single_reply_cutoff=False)
+    result = search.Searcher(game_state, limits, _worker_tt).run()
+    score = -result.score
+    if score >= search.MATE_BOUND:
+        score -= 1
+    elif score <= -search.MATE_BOUND:
+        score += 1
+    return code, score, [move.code for move in result.pv], result.nodes, result.depth + 1
+
+
+def parallel_perft(game_state, depth, workers=None, executor=None):
+    fen = game_state.to_fen()
+    moves = game_state.get_valid_moves()
+    if depth <= 1:
+        return len(moves), [(move.get_chess_notation(), 1) for move in moves]
+
+    notation = {move.code: move.get_chess_notation() for move in moves}
+    pool = executor or ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+    try:
+        futures = [pool.submit(perft_task, fen, move.code, depth) for move in moves]
+        results = [future.result() for future in as_completed(futures)]
+    finally:
+        if executor is None:
+            pool.shutdown()
+
+    divide = sorted((notation[code], nodes) for code, nodes in results)
+    return sum(nodes for _, nodes in divide), divide
+
+
+def parallel_search(game_state, limits, workers=None, executor=None):
+    start = time.perf_counter()
+    data = bytes(encode(game_state))
+    moves = game_state.get_valid_moves()
+    if not moves:
+        return search.SearchResult(None, -search.MATE if game_state.checkmate else 0, [], 0, 0, 0.0)
+
+    workers = workers or os.cpu_count()
+    rounds = -(-len(moves) // workers)
+    movetime = limits.movetime / rounds if limits.movetime is not None else None
+    nodes = max(1, limits.nodes // len(moves)) if limits.nodes is not None else None
+    depth = limits.depth if limits.depth is not None or limits.movetime is not None or nodes is not None else 4
+
+    pool = executor or ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [pool.submit(search_task, data, move.code, depth, movetime, nodes) for move in moves]
+        results = [future.result() for future in as_completed(futures)]
+    finally:
+        if executor is None:
+            pool.shutdown()
+
+    order = {move.code: index for index, move in enumerate(moves)}
+    code, score, child_pv, _, completed_depth = max(results, key=lambda result: (result[1], -order[result[0]]))
+    pv = []
+    for pv_code in [code] + child_pv:
+        pv.append(game_state.decode_move(pv_code))
+        game_state.make_move(pv_code)
+    for _ in pv:
+        game_state.undo_move()
+
+    return search.SearchResult(pv[0], score, pv, sum(result[3] for result in results),
+                               min(result[4] for result in results), time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split perft counting or search across worker processes by root move.')
+    parser.add_argument('mode', choices=('perft', 'search'))
+    parser.add_argument('--fen', default=engine.START_FEN)
+    parser.add_argument('--position', choices=sorted(perft.POSITIONS), help='reference position to use instead of --fen')
+    parser.add_argument('--depth', type=int, default=None)
+    parser.add_argument('--movetime', type=float, default=None, help='search time in seconds')
+    parser.add_argument('--nodes', type=int, default=None, help='search node budget')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    fen = perft.POSITIONS[args.position][0] if args.position else args.fen
+    game_state = engine.GameState.from_fen(fen)
+    start = time.perf_counter()
+
+    if args.mode == 'perft':
+        nodes, divide = parallel_perft(game_state, args.depth or 4, args.workers)
+        for notation, count in divide:
+            print(f'{notation}: {count}')
+        elapsed = time.perf_counter() - start
+        expected = perft.POSITIONS[args.position][1] if args.position else ()
+        status = ''
+        if len(expected) >= (args.depth or 4):
+            status = '  ok' if expected[(args.depth or 4) - 1] == nodes else '  MISMATCH'
+        print(f'nodes: {nodes}  time: {elapsed:.3f}s  nps: {nodes / max(elapsed, 1e-9):.0f}  '
+              f'workers: {args.workers}{status}')
+        return 1 if status == '  MISMATCH' else 0
+
+    result = parallel_search(game_state, search.SearchLimits(args.depth, args.movetime, args.nodes), args.workers)
+    elapsed = time.perf_counter() - start
+    print(f'bestmove {result.best_move.get_chess_notation() if result.best_move else "(none)"}  score {result.score}  '
+          f'depth {result.depth}  nodes {result.nodes}  nps {result.nodes / max(elapsed, 1e-9):.0f}  '
+          f'pv {" ".join(move.get_chess_notation() for move in result.pv)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
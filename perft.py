@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import random
+import sys
+import time
+
+import engine
+import instrument
+
+POSITIONS = {
+    'startpos': (engine.START_FEN, (20, 400, 8902, 197281, 4865609, 119060324)),
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+                 (48, 2039, 97862, 4085603, 193690690)),
+    'position3': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', (14, 191, 2812, 43238, 674624, 11030083)),
+    'position4': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+                  (6, 264, 9467, 422333, 15833292)),
+    'position5': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', (44, 1486, 62379, 2103487, 89941194)),
+    'position6': ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+                  (46, 2079, 89890, 3894594, 164075551)),
+    'illegal_enpassant_1': ('3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1', (18, 92, 1670, 10138, 185429, 1134888)),
+    'illegal_enpassant_2': ('8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1', (13, 102, 1266, 10276, 135655, 1015133)),
+    'enpassant_check': ('8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1', (15, 126, 1928, 13931, 206379, 1440467)),
+    'short_castle_check': ('5k2/8/8/8/8/8/8/4K2R w K - 0 1', (15, 66, 1198, 6399, 120330, 661072)),
+    'long_castle_check': ('3k4/8/8/8/8/8/8/R3K3 w Q - 0 1', (16, 71, 1286, 7418, 141077, 803711)),
+    'castle_rights': ('r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1', (26, 1141, 27826, 1274206)),
+    'castle_prevented': ('r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1', (44, 1494, 50509, 1720476)),
+    'promote_out_of_check': ('2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1', (11, 133, 1442, 19174, 266199, 3821001)),
+    'discovered_check': ('8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1', (29, 165, 5160, 31961, 1004658)),
+    'promote_to_check': ('4k3/1P6/8/8/8/8/K7/8 w - - 0 1', (9, 40, 472, 2661, 38983, 217342)),
+    'underpromote_to_check': ('8/P1k5/K7/8/8/8/8/8 w - - 0 1', (6, 27, 273, 1329, 18135, 92683)),
+    'self_stalemate': ('K1k5/8/P7/8/8/8/8/8 w - - 0 1', (2, 6, 13, 63, 382, 2217)),
+    'stalemate_checkmate_1': ('8/k1P5/8/1K6/8/8/8/8 w - - 0 1', (10, 25, 268, 926, 10857, 43261, 567584)),
+    'stalemate_checkmate_2': ('8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1', (37, 183, 6559, 23527)),
+}
+
+KNIGHT_STEPS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+KING_STEPS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+ROOK_STEPS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+BISHOP_STEPS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+def perft(game_state, depth):
+    if depth == 0:
+        return 1
+
+    moves = game_state.get_valid_move_codes()
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        game_state.make_move(move)
+        nodes += perft(game_state, depth - 1)
+        game_state.undo_move()
+    return nodes
+
+
+def divide(game_state, depth):
+    results = []
+    for move in game_state.get_valid_moves():
+        game_state.make_move(move.code)
+        results.append((move.get_chess_notation(), perft(game_state, depth - 1)))
+        game_state.undo_move()
+    return results
+
+
+def timed_perft(fen, depth):
+    game_state = engine.GameState.from_fen(fen)
+    start = time.perf_counter()
+    nodes = perft(game_state, depth)
+    elapsed = time.perf_counter() - start
+    return nodes, elapsed
+
+
+def reference_attackers(squares, square, color):
+    # Brute-force reference for GameState.get_attackers: steps over the board square by square, without any of
+    # the engine's attack tables.
+    row, column = divmod(square, 8)
+    attackers = 0
+    pawn_row = row + 1 if color == 'w' else row - 1
+    for step_row, step_column in KNIGHT_STEPS + KING_STEPS + ((pawn_row - row, -1), (pawn_row - row, 1)):
+        target_row, target_column = row + step_row, column + step_column
+        if 0 <= target_row < 8 and 0 <= target_column < 8:
+            piece = squares[target_row * 8 + target_column]
+            if piece[0] != color:
+                continue
+            if ((step_row, step_column) in KNIGHT_STEPS and piece[1] == 'N' or
+                    (step_row, step_column) in KING_STEPS and piece[1] == 'K' or
+                    target_row == pawn_row and abs(step_column) == 1 and piece[1] == 'P'):
+                attackers |= 1 << (target_row * 8 + target_column)
+    for steps, sliders in ((ROOK_STEPS, 'RQ'), (BISHOP_STEPS, 'BQ')):
+        for step_row, step_column in steps:
+            target_row, target_column = row + step_row, column + step_column
+            while 0 <= target_row < 8 and 0 <= target_column < 8:
+                piece = squares[target_row * 8 + target_column]
+                if piece != '--':
+                    if piece[0] == color and piece[1] in sliders:
+                        attackers |= 1 << (target_row * 8 + target_column)
+                    break
+                target_row += step_row
+                target_column += step_column
+    return attackers
+
+
+def reference_under_attack(game_state, row, column):
+    # The original square_under_attack, kept as its reference: generates every opponent move and looks for one that
+    # lands on the square. Pawn pushes count too, so it only agrees with the real query on occupied squares.
+    square = row * 8 + column
+    game_state.white_to_move = not game_state.white_to_move
+    opponent_moves = game_state.get_possible_move_codes()
+    game_state.white_to_move = not game_state.white_to_move
+    for code in opponent_moves:
+        if (code >> 6) & 63 == square:
+            return True
+    return False
+
+
+def check_attacks(names, games, plies, seed, out=sys.stdout):
+    # Differential check along random games from the reference positions. square_under_attack is compared with
+    # the original move-generation version on every square holding a side-to-move piece, and with the board walk
+    # on every square; get_attackers is compared with the board walk on every square, for both colors.
+    rng = random.Random(seed)
+    queries = 0
+    failures = 0
+    start = time.perf_counter()
+    for name in names:
+        for _ in range(games):
+            game_state = engine.GameState.from_fen(POSITIONS[name][0])
+            for _ in range(plies):
+                squares = game_state.squares
+                own_color, enemy_color = ('w', 'b') if game_state.white_to_move else ('b', 'w')
+                for square in range(64):
+                    expected = {color: reference_attackers(squares, square, color) for color in 'wb'}
+                    for color in 'wb':
+                        if game_state.get_attackers(square, color) != expected[color]:
+                            failures += 1
+                            print(f'get_attackers mismatch: {game_state.to_fen()}  square {square}  {color}',
+                                  file=out)
+                    attacked = game_state.square_under_attack(*divmod(square, 8))
+                    if attacked != bool(expected[enemy_color]) or (
+                            squares[square][0] == own_color and
+                            attacked != reference_under_attack(game_state, *divmod(square, 8))):
+                        failures += 1
+                        print(f'square_under_attack mismatch: {game_state.to_fen()}  square {square}', file=out)
+                    queries += 3
+                moves = game_state.get_valid_move_codes()
+                if not moves:
+                    break
+                game_state.make_move(rng.choice(moves))
+    print(f'attacks: {queries} queries in {time.perf_counter() - start:.3f}s, {failures} mismatches', file=out)
+    return failures
+
+
+def run_suite(names, max_depth, max_nodes, out=sys.stdout):
+    failures = 0
+    total_nodes = 0
+    total_time = 0.0
+
+    for name in names:
+        fen, expected_counts = POSITIONS[name]
+        for depth, expected in enumerate(expected_counts[:max_depth], 1):
+            if expected > max_nodes:
+                break
+
+            nodes, elapsed = timed_perft(fen, depth)
+            total_nodes += nodes
+            total_time += elapsed
+            status = 'ok' if nodes == expected else 'MISMATCH'
+            if nodes != expected:
+                failures += 1
+
+            print(f'{name:<24} depth {depth}  {nodes:>10}  expected {expected:>10}  '
+                  f'{elapsed:8.3f}s  {nodes / max(elapsed, 1e-9):>10.0f} nps  {status}', file=out)
+
+    print(f'total {total_nodes} nodes in {total_time:.3f}s ({total_nodes / max(total_time, 1e-9):.0f} nps), '
+          f'{failures} mismatches', file=out)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Count leaf nodes of the legal move tree and check them against '
+                                                 'published reference counts.')
+    parser.add_argument('--fen', help='position to count instead of running the reference suite')
+    parser.add_argument('--position', action='append', choices=sorted(POSITIONS),
+                        help='reference position to run (repeatable, defaults to all)')
+    parser.add_argument('--depth', type=int, default=None, help='depth to count to')
+    parser.add_argument('--divide', action='store_true', help='print the node count below each root move')
+    parser.add_argument('--max-nodes', type=int, default=250000,
+                        help='skip reference depths with more nodes than this (default: %(default)s)')
+    parser.add_argument('--attacks', type=int, metavar='GAMES',
+                        help='compare the attack queries with the reference versions over GAMES random games from '
+                             'each position (the default run checks one short game per position)')
+    parser.add_argument('--plies', type=int, default=60, help='plies per random game for --attacks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', nargs='?', const='perft.prof', metavar='PATH',
+                        help='instrument the engine and write pstats-compatible stats to PATH')
+    args = parser.parse_args(argv)
+
+    with instrument.profiling(args.profile):
+        if args.attacks:
+            return 1 if check_attacks(args.position or list(POSITIONS), args.attacks, args.plies, args.seed) else 0
+
+        if args.fen or args.divide:
+            fen = args.fen or POSITIONS[(args.position or ['startpos'])[0]][0]
+            depth = args.depth or 3
+            game_state = engine.GameState.from_fen(fen)
+            start = time.perf_counter()
+            if args.divide:
+                results = divide(game_state, depth)
+                for notation, nodes in results:
+                    print(f'{notation}: {nodes}')
+                nodes = sum(nodes for notation, nodes in results)
+                print(f'moves: {len(results)}')
+            else:
+                nodes = perft(game_state, depth)
+            elapsed = time.perf_counter() - start
+            print(f'nodes: {nodes}  time: {elapsed:.3f}s  nps: {nodes / max(elapsed, 1e-9):.0f}')
+            return 0
+
+        names = args.position or list(POSITIONS)
+        failures = run_suite(names, args.depth or 99, args.max_nodes)
+        failures += check_attacks(names, 1, 20, args.seed)
+        return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
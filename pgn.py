@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from engine import (CAPTURE, FLAGS, KING_CASTLE, PROMOTION, PROMOTION_PIECES, QUEEN_CASTLE, SQUARE_NAMES,
+                    START_FEN, GameState)
+import instrument
+from epd import iterate_lines
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+HEADER_ORDER = ('Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result')
+
+
+class Game:
+    __slots__ = ('headers', 'movetext', 'number')
+
+    def __init__(self, headers, movetext, number=0):
+        self.headers = headers
+        self.movetext = movetext
+        self.number = number
+
+    @property
+    def start_fen(self):
+        return self.headers.get('FEN', START_FEN)
+
+
+def to_san(game_state, code):
+    start = code & 63
+    end = (code >> 6) & 63
+    flags = code & FLAGS
+    piece = game_state.squares[start][1]
+
+    if flags == KING_CASTLE:
+        san = 'O-O'
+    elif flags == QUEEN_CASTLE:
+        san = 'O-O-O'
+    elif piece == 'P':
+        san = SQUARE_NAMES[start][0] + 'x' if code & CAPTURE else ''
+        san += SQUARE_NAMES[end]
+        if code & PROMOTION:
+            san += '=' + PROMOTION_PIECES[(code >> 12) & 3]
+    else:
+        rivals = [other & 63 for other in game_state.get_valid_move_codes()
+                  if (other >> 6) & 63 == end and other & 63 != start and game_state.squares[other & 63][1] == piece]
+        san = piece
+        if rivals:
+            if all(other % 8 != start % 8 for other in rivals):
+                san += SQUARE_NAMES[start][0]
+            elif all(other // 8 != start // 8 for other in rivals):
+                san += SQUARE_NAMES[start][1]
+            else:
+                san += SQUARE_NAMES[start]
+        san += ('x' if code & CAPTURE else '') + SQUARE_NAMES[end]
+
+    game_state.make_move(code)
+    replies = game_state.get_valid_move_codes()
+    if game_state.checkers:
+        san += '+' if replies else '#'
+    game_state.undo_move()
+    return san
+
+
+def parse_san(game_state, san):
+    # Resolves a SAN token against the legal move codes of the position; raises ValueError if it names no legal
+    # move or more than one.
+    token = san.rstrip('+#!?')
+    moves = game_state.get_valid_move_codes()
+    if token in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        flag = KING_CASTLE if len(token) == 3 else QUEEN_CASTLE
+        matches = [code for code in moves if code & FLAGS == flag]
+    else:
+        promotion = None
+        if '=' in token:
+            token, promotion = token.split('=', 1)
+        elif token[-1:] in 'NBRQ' and token[:1].islower():
+            token, promotion = token[:-1], token[-1]
+        if len(token) < 2 or token[-2:] not in SQUARE_NAMES:
+            raise ValueError(f'Invalid SAN move: {san!r}')
+        end = SQUARE_NAMES.index(token[-2:])
+        piece = token[0] if token[0] in 'NBRQK' else 'P'
+        hint = token[1 if piece != 'P' else 0:-2].replace('x', '')
+        matches = []
+        for code in moves:
+            if (code >> 6) & 63 != end or game_state.squares[code & 63][1] != piece:
+                continue
+            if code & FLAGS in (KING_CASTLE, QUEEN_CASTLE):
+                continue
+            name = SQUARE_NAMES[code & 63]
+            if any(char not in name for char in hint):
+                continue
+            if (PROMOTION_PIECES[(code >> 12) & 3] if code & PROMOTION else None) != (promotion and promotion.upper()):
+                continue
+            matches.append(code)
+    if len(matches) != 1:
+        raise ValueError(f'{"Ambiguous" if matches else "Illegal"} SAN move {san!r} in {game_state.to_fen()}')
+    return matches[0]
+
+
+def read_games(path):
+    # Streams one game at a time: headers until the first movetext line, then movetext until the next header.
+    headers = {}
+    movetext = []
+    number = 0
+    for line in iterate_lines(path):
+        line = line.strip()
+        if line.startswith('['):
+            if movetext:
+                number += 1
+                yield Game(headers, '\n'.join(movetext), number)
+                headers, movetext = {}, []
+            name, _, value = line[1:-1].partition(' ')
+            headers[name] = value.strip().strip('"')
+        elif line and not line.startswith('%'):
+            movetext.append(line)
+    if movetext or headers:
+        number += 1
+        yield Game(headers, '\n'.join(movetext), number)
+
+
+def tokenize(movetext):
+    # Yields SAN tokens, skipping comments, variations, NAGs and move numbers (all-digit tokens, so 0-0 survives).
+    depth = 0
+    comment_end = None
+    token = ''
+    for char in movetext + ' ':
+        if comment_end:
+            if char == comment_end:
+                comment_end = None
+        elif char in '{;().' or char.isspace():
+            if token and not depth and (token in RESULTS or not (token.isdigit() or token[0] == '$')):
+                yield token
+            token = ''
+            if char == '{':
+                comment_end = '}'
+            elif char == ';':
+                comment_end = '\n'
+            elif char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+        else:
+            token += char
+
+
+def replay(game, collect_fens=False):
+    # Returns (number of moves, result token, FENs of every position, error message or None).
+    result = game.headers.get('Result', '*')
+    try:
+        game_state = GameState.from_fen(game.start_fen)
+    except ValueError as error:
+        return 0, result, [] if collect_fens else None, f'game {game.number}: {error}'
+    fens = [game_state.to_fen()] if collect_fens else None
+    moves = 0
+    for token in tokenize(game.movetext):
+        if token in RESULTS:
+            result = token
+            break
+        try:
+            game_state.make_move(parse_san(game_state, token))
+        except ValueError as error:
+            return moves, result, fens, f'game {game.number}: {error}'
+        moves += 1
+        if collect_fens:
+            fens.append(game_state.to_fen())
+    return moves, result, fens, None
+
+
+def replay_batch(games, collect_fens=False):
+    moves = 0
+    errors = []
+    fens = [] if collect_fens else None
+    for game in games:
+        count, _, game_fens, error = replay(game, collect_fens)
+        moves += count
+        if error:
+            errors.append(error)
+        if collect_fens:
+            fens.extend(game_fens)
+    return len(games), moves, errors, fens
+
+
+def batches(games, size):
+    batch = []
+    for game in games:
+        batch.append(game)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process(path, workers=1, batch_size=64, collect_fens=False, callback=None):
+    # Replays every game in the file and returns (games, moves, errors). With more than one worker, batches of
+    # games are fanned out to a process pool while at most two batches per worker are in flight, so memory stays
+    # flat regardless of file size. callback receives each finished batch's FEN list when collect_fens is set.
+    games = moves = 0
+    errors = []
+
+    def collect(result):
+        nonlocal games, moves
+        games += result[0]
+        moves += result[1]
+        errors.extend(result[2])
+        if callback is not None and result[3] is not None:
+            callback(result[3])
+
+    if workers <= 1:
+        for batch in batches(read_games(path), batch_size):
+            collect(replay_batch(batch, collect_fens))
+        return games, moves, errors
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for batch in batches(read_games(path), batch_size):
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+            pending.add(pool.submit(replay_batch, batch, collect_fens))
+        for future in pending:
+            collect(future.result())
+    return games, moves, errors
+
+
+def export_game(game_state, headers=None, start_fen=START_FEN):
+    # Rebuilds the game from start_fen and game_state.move_log so the moves can be written in SAN.
+    headers = dict(headers or {})
+    for name in HEADER_ORDER:
+        headers.setdefault(name, '*' if name == 'Result' else '?')
+    if start_fen != START_FEN:
+        headers.setdefault('SetUp', '1')
+        headers.setdefault('FEN', start_fen)
+
+    replay_state = GameState.from_fen(start_fen)
+    tokens = []
+    for code in game_state.move_log:
+        if replay_state.white_to_move:
+            tokens.append(f'{replay_state.fullmove_number}.')
+        elif not tokens:
+            tokens.append(f'{replay_state.fullmove_number}...')
+        tokens.append(to_san(replay_state, code))
+        replay_state.make_move(code)
+    tokens.append(headers['Result'])
+
+    lines = [f'[{name} "{value}"]' for name, value in headers.items()]
+    lines.append('')
+    line = ''
+    for token in tokens:
+        if len(line) + len(token) >= 80:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay and validate every game in a PGN file.')
+    parser.add_argument('path')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch', type=int, default=64, help='games sent to a worker at a time')
+    parser.add_argument('--fens', help='write the FEN of every replayed position to this file')
+    parser.add_argument('--profile', nargs='?', const='pgn.prof', metavar='PATH',
+                        help='instrument the engine and write pstats-compatible stats to PATH')
+    args = parser.parse_args(argv)
+    if args.profile:
+        # Worker processes are not instrumented, so profile in-process.
+        args.workers = 1
+
+    with instrument.profiling(args.profile):
+        output = open(args.fens, 'w') if args.fens else None
+        start = time.perf_counter()
+        try:
+            games, moves, errors = process(args.path, args.workers, args.batch, output is not None,
+                                           (lambda fens: output.write('\n'.join(fens) + '\n')) if output else None)
+        finally:
+            if output is not None:
+                output.close()
+        elapsed = time.perf_counter() - start
+
+        for error in errors:
+            print(error, file=sys.stderr)
+        print(f'games: {games}  moves: {moves}  errors: {len(errors)}  time: {elapsed:.3f}s  '
+              f'games/s: {games / max(elapsed, 1e-9):.0f}  moves/s: {moves / max(elapsed, 1e-9):.0f}  '
+              f'workers: {args.workers}')
+        return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
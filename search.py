@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from engine import CAPTURE, ENPASSANT, FLAGS, PROMOTION
+from tt import EXACT, LOWER, UPPER, TranspositionTable
+
+INFINITY = 1000000
+MATE = 100000
+MAX_PLY = 64
+# Scores beyond MATE_BOUND are mates. The margin leaves room for tablebase distances (KPK reaches 56 plies) on top
+# of the search ply, so those scores are still treated as mates.
+MATE_BOUND = MATE - 1000
+
+PIECE_VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 20000}
+
+# Piece-square tables from white's point of view, indexed like GameState.squares (a8 first).
+PIECE_SQUARE_TABLES = {
+    'P': (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0
+    ),
+    'N': (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50
+    ),
+    'B': (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20
+    ),
+    'R': (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0
+    ),
+    'Q': (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20
+    ),
+    'K': (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20
+    ),
+}
+KING_ENDGAME_TABLE = (
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50
+)
+
+
+class SearchLimits:
+    # single_reply_cutoff stops deepening when the root has one legal move; split searches turn it off so every
+    # root move is searched to the same depth.
+    def __init__(self, depth=None, movetime=None, nodes=None, single_reply_cutoff=True):
+        self.depth = depth
+        self.movetime = movetime
+        self.nodes = nodes
+        self.single_reply_cutoff = single_reply_cutoff
+
+
+class SearchResult:
+    def __init__(self, best_move, score, pv, nodes, depth, elapsed):
+        self.best_move = best_move
+        self.score = score
+        self.pv = pv
+        self.nodes = nodes
+        self.depth = depth
+        self.elapsed = elapsed
+
+
+class SearchAborted(Exception):
+    pass
+
+
+def evaluate(game_state):
+    pieces = game_state.pieces
+    endgame = not (pieces['wQ'] | pieces['bQ']) or (
+        bin(pieces['wN'] | pieces['wB'] | pieces['wR'] | pieces['bN'] | pieces['bB'] | pieces['bR']).count('1') <= 2)
+    score = 0
+    for piece, bitboard in pieces.items():
+        value = PIECE_VALUES[piece[1]]
+        table = KING_ENDGAME_TABLE if endgame and piece[1] == 'K' else PIECE_SQUARE_TABLES[piece[1]]
+        if piece[0] == 'w':
+            while bitboard:
+                bit = bitboard & -bitboard
+                score += value + table[bit.bit_length() - 1]
+                bitboard ^= bit
+        else:
+            while bitboard:
+                bit = bitboard & -bitboard
+                score -= value + table[(bit.bit_length() - 1) ^ 56]
+                bitboard ^= bit
+    return score if game_state.white_to_move else -score
+
+
+def tablebase_score(entry, ply):
+    # Converts a Tablebase.probe() (result, plies to mate) into a mate score relative to the root.
+    result, plies = entry
+    if result > 0:
+        return MATE - ply - plies
+    if result < 0:
+        return -MATE + ply + plies
+    return 0
+
+
+def score_to_tt(score, ply):
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+class Searcher:
+    # stop_event is any object with is_set() (normally a threading.Event) that aborts the search from another
+    # thread; on_iteration(depth, score, pv_codes, nodes, elapsed) is called after every completed iteration.
+    # tablebase is an optional tablebase.Tablebase answering positions with three pieces or fewer exactly.
+    def __init__(self, game_state, limits, tt=None, stop_event=None, on_iteration=None, tablebase=None):
+        self.game_state = game_state
+        self.limits = limits
+        self.tt = tt if tt is not None else TranspositionTable()
+        self.stop_event = stop_event
+        self.on_iteration = on_iteration
+        self.tablebase = tablebase
+        self.nodes = 0
+        self.deadline = None
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        self.history = [0] * 4096
+        self.pv_moves = [0] * MAX_PLY
+
+    def check_limits(self):
+        if self.limits.nodes is not None and self.nodes >= self.limits.nodes:
+            raise SearchAborted
+        if self.nodes & 255 == 0:
+            if self.stop_event is not None and self.stop_event.is_set():
+                raise SearchAborted
+            if self.deadline is not None and time.perf_counter() >= self.deadline:
+                raise SearchAborted
+
+    def order_moves(self, moves, ply, tt_move=0):
+        squares = self.game_state.squares
+        killers = self.killers[ply]
+        pv_move = self.pv_moves[ply]
+        history = self.history
+        scores = {}
+        for code in moves:
+            if code == tt_move:
+                scores[code] = 1 << 31
+            elif code == pv_move:
+                scores[code] = 1 << 30
+            elif code & CAPTURE:
+                victim = 'P' if code & FLAGS == ENPASSANT else squares[(code >> 6) & 63][1]
+                scores[code] = (1 << 24) + PIECE_VALUES[victim] * 16 - PIECE_VALUES[squares[code & 63][1]] // 100
+            elif code & PROMOTION:
+                scores[code] = 1 << 23
+            elif code == killers[0]:
+                scores[code] = 1 << 22
+            elif code == killers[1]:
+                scores[code] = (1 << 22) - 1
+            else:
+                scores[code] = history[code & 4095]
+        moves.sort(key=scores.__getitem__, reverse=True)
+        return moves
+
+    def quiescence(self, alpha, beta, ply):
+        self.nodes += 1
+        self.check_limits()
+        game_state = self.game_state
+
+        moves = game_state.get_valid_move_codes()
+        if not moves:
+            return -MATE + ply if game_state.checkmate else 0
+
+        in_check = bool(game_state.checkers)
+        if not in_check:
+            stand_pat = evaluate(game_state)
+            if stand_pat >= beta or ply >= MAX_PLY - 1:
+                return stand_pat
+            if stand_pat > alpha:
+                alpha = stand_pat
+            moves = [code for code in moves if code & (CAPTURE | PROMOTION)]
+        elif ply >= MAX_PLY - 1:
+            return evaluate(game_state)
+
+        for code in self.order_moves(moves, ply):
+            game_state.make_move(code)
+            score = -self.quiescence(-beta, -alpha, ply + 1)
+            game_state.undo_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def negamax(self, depth, alpha, beta, ply):
+        if depth <= 0:
+            return self.quiescence(alpha, beta, ply), []
+
+        self.nodes += 1
+        self.check_limits()
+        game_state = self.game_state
+        key = game_state.zobrist_key
+        original_alpha = alpha
+
+        # A position seen before on this line, a fifty-move count or dead material scores as a draw.
+        if ply > 0 and (game_state.repetitions[key] > 1 or game_state.halfmove_clock >= 100 or
+                        game_state.has_insufficient_material()):
+            return 0, []
+
+        if ply > 0 and self.tablebase is not None and bin(game_state.occupied).count('1') <= 3:
+            entry = self.tablebase.probe(game_state)
+            if entry is not None:
+                return tablebase_score(entry, ply), []
+
+        tt_move = 0
+        entry = self.tt.probe(key)
+        if entry is not None:
+            tt_move, tt_score, tt_depth, tt_bound = entry
+            if ply > 0 and tt_depth >= depth:
+                tt_score = score_from_tt(tt_score, ply)
+                if tt_bound == EXACT or (tt_bound == LOWER and tt_score >= beta) or (
+                        tt_bound == UPPER and tt_score <= alpha):
+                    return tt_score, ([tt_move] if tt_move else [])
+
+        moves = game_state.get_valid_move_codes()
+        if not moves:
+            return (-MATE + ply if game_state.checkmate else 0), []
+        if tt_move not in moves:
+            tt_move = 0
+
+        best_score = -INFINITY
+        best_pv = []
+        for code in self.order_moves(moves, ply, tt_move):
+            game_state.make_move(code)
+            score, child_pv = self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            score = -score
+            game_state.undo_move()
+
+            if score > best_score:
+                best_score = score
+                best_pv = [code] + child_pv
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        if not code & (CAPTURE | PROMOTION):
+                            killers = self.killers[ply]
+                            if killers[0] != code:
+                                killers[1] = killers[0]
+                                killers[0] = code
+                            self.history[code & 4095] += depth * depth
+                        break
+
+        if best_score <= original_alpha:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.tt.store(key, depth, bound, score_to_tt(best_score, ply), best_pv[0])
+        return best_score, best_pv
+
+    def run(self):
+        game_state = self.game_state
+        limits = self.limits
+        start = time.perf_counter()
+        if limits.movetime is not None:
+            self.deadline = start + limits.movetime
+        self.tt.new_search()
+        root_length = len(game_state.move_log)
+        max_depth = min(limits.depth or MAX_PLY - 1, MAX_PLY - 1)
+
+        root_moves = game_state.get_valid_move_codes()
+        best_code, best_score, best_pv, completed_depth = (root_moves[0] if root_moves else 0), 0, [], 0
+        if not root_moves:
+            best_score = -MATE if game_state.checkmate else 0
+
+        # A tablebase hit at the root already knows the best move and the exact result.
+        if root_moves and self.tablebase is not None:
+            code = self.tablebase.best_move(game_state)
+            if code is not None:
+                best_code, best_score, best_pv = code, tablebase_score(self.tablebase.probe(game_state), 0), [code]
+                if self.on_iteration is not None:
+                    self.on_iteration(1, best_score, best_pv, self.nodes, time.perf_counter() - start)
+                max_depth = 0
+
+        for depth in range(1, max_depth + 1 if root_moves else 1):
+            try:
+                score, pv = self.negamax(depth, -INFINITY, INFINITY, 0)
+            except SearchAborted:
+                while len(game_state.move_log) > root_length:
+                    game_state.undo_move()
+                break
+            best_code, best_score, best_pv, completed_depth = pv[0], score, pv, depth
+            self.pv_moves[:len(pv)] = pv
+            if self.on_iteration is not None:
+                self.on_iteration(depth, score, pv, self.nodes, time.perf_counter() - start)
+            if abs(score) >= MATE_BOUND or (len(root_moves) == 1 and limits.single_reply_cutoff):
+                break
+
+        pv_moves = []
+        for code in best_pv:
+            pv_moves.append(game_state.decode_move(code))
+            game_state.make_move(code)
+        for _ in best_pv:
+            game_state.undo_move()
+
+        best_move = game_state.decode_move(best_code) if root_moves else None
+        return SearchResult(best_move, best_score, pv_moves, self.nodes, completed_depth,
+                            time.perf_counter() - start)
+
+
+def search(game_state, limits=None, tt=None, stop_event=None, on_iteration=None, tablebase=None):
+    return Searcher(game_state, limits or SearchLimits(depth=4), tt, stop_event, on_iteration, tablebase).run()
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import math
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import START_FEN, GameState
+from pgn import parse_san
+from search import SearchLimits, search
+from snapshot import decode, encode
+from tt import TranspositionTable
+from uci import move_notation
+
+# One JSON object per line in each direction. Every request carries an 'op' and may carry an 'id', which is echoed
+# back so a client can pipeline requests: engine replies arrive whenever they finish, not in request order.
+DEFAULT_PORT = 8765
+DEFAULT_DEADLINE = 5.0
+DEFAULT_MOVETIME = 1.0
+SEARCH_OVERHEAD = 0.1
+LATENCY_SAMPLES = 10000
+CONNECTION_INFLIGHT = 64
+# Latency is recorded per known op; anything else shares one bucket, so clients cannot grow the stats.
+OPS = ('new', 'move', 'moves', 'state', 'undo', 'engine', 'close', 'stats')
+
+_worker_tt = None
+
+
+class ServerError(Exception):
+    pass
+
+
+def engine_search(data, movetime, depth):
+    # Runs in a pool process on a snapshot of the game, whose history lets the search see repetitions; each
+    # process keeps one transposition table across requests.
+    global _worker_tt
+    if _worker_tt is None:
+        _worker_tt = TranspositionTable()
+    game_state = decode(data)
+    result = search(game_state, SearchLimits(depth, movetime), _worker_tt)
+    code = result.best_move.code if result.best_move is not None else None
+    return code, result.score, result.nodes, result.depth, result.elapsed
+
+
+class Session:
+    def __init__(self, fen=START_FEN):
+        self.game_state = GameState.from_fen(fen)
+        self.codes = []
+        self.legal = None
+        self.status = None
+
+    def legal_moves(self):
+        # notation -> code for the current position, generated once per position and kept until the next move.
+        if self.legal is None:
+            game_state = self.game_state
+            self.legal = {move_notation(code): code for code in game_state.get_valid_move_codes()}
+            if game_state.checkmate:
+                self.status = 'checkmate'
+            elif game_state.stalemate:
+                self.status = 'stalemate'
+            else:
+                self.status = game_state.get_draw_reason()
+        return self.legal
+
+    def play(self, notation):
+        legal = self.legal_moves()
+        code = legal.get(notation)
+        if code is None:
+            try:
+                code = parse_san(self.game_state, notation)
+            except ValueError:
+                raise ServerError(f'illegal move {notation}') from None
+        self.game_state.make_move(code)
+        self.codes.append(code)
+        self.legal = None
+        return code
+
+    def undo(self):
+        if not self.codes:
+            raise ServerError('no move to undo')
+        self.game_state.undo_move()
+        self.codes.pop()
+        self.legal = None
+
+    def describe(self, with_moves=False):
+        legal = self.legal_moves()
+        state = {'fen': self.game_state.to_fen(), 'status': self.status, 'ply': len(self.codes)}
+        if with_moves:
+            state['moves'] = sorted(legal)
+        return state
+
+
+class LatencyStats:
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=size))
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+
+    def record(self, op, elapsed, ok=True):
+        self.samples[op].append(elapsed)
+        self.counts[op] += 1
+        if not ok:
+            self.errors[op] += 1
+
+    def summary(self):
+        # Percentiles in milliseconds over the most recent samples of each op.
+        summary = {}
+        for op, samples in self.samples.items():
+            ordered = sorted(samples)
+            summary[op] = {
+                'count': self.counts[op],
+                'errors': self.errors[op],
+                'p50': ordered[len(ordered) // 2] * 1000,
+                'p90': ordered[len(ordered) * 9 // 10] * 1000,
+                'p99': ordered[len(ordered) * 99 // 100] * 1000,
+                'max': ordered[-1] * 1000,
+            }
+        return summary
+
+
+class EnginePool:
+    # Engine requests wait for one of `workers` processes; once workers + max_queue requests are waiting or
+    # running, new ones are refused straight away instead of growing the queue. A request whose deadline passes
+    # while queued never reaches a process, and a running search gets the time left as its movetime.
+    def __init__(self, workers, max_queue):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.slots = asyncio.Semaphore(workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def release(self, future):
+        self.running -= 1
+        self.slots.release()
+
+    def return_slot(self, acquire):
+        if not acquire.cancelled():
+            self.slots.release()
+
+    async def acquire_slot(self, timeout):
+        # The acquire runs as its own task, so a timeout or cancellation that races with it can tell whether the
+        # slot was granted anyway and hand it back instead of leaking it.
+        acquire = asyncio.ensure_future(self.slots.acquire())
+        try:
+            await asyncio.wait((acquire,), timeout=timeout)
+        finally:
+            if not acquire.done():
+                acquire.cancel()
+                acquire.add_done_callback(self.return_slot)
+        return acquire.done() and not acquire.cancelled()
+
+    async def run(self, deadline, data, movetime, depth):
+        loop = asyncio.get_running_loop()
+        if self.queued + self.running >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise ServerError('engine busy')
+
+        self.queued += 1
+        try:
+            acquired = await self.acquire_slot(max(deadline - loop.time(), 0))
+        finally:
+            self.queued -= 1
+        if not acquired:
+            self.timeouts += 1
+            raise ServerError('deadline exceeded while queued')
+
+        # The slot is freed when the process finishes, not when the caller gives up, so a late search still
+        # counts against the pool. Every search, depth-limited ones included, is capped by the deadline so a
+        # worker is never held past it.
+        remaining = deadline - loop.time()
+        movetime = max(min(movetime if movetime is not None else math.inf, remaining - SEARCH_OVERHEAD), 0.01)
+        self.running += 1
+        future = loop.run_in_executor(self.executor, engine_search, data, movetime, depth)
+        future.add_done_callback(self.release)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), max(remaining, 0))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise ServerError('deadline exceeded') from None
+        self.completed += 1
+        return result
+
+    def stats(self):
+        return {'workers': self.workers, 'queued': self.queued, 'running': self.running, 'completed': self.completed,
+                'rejected': self.rejected, 'timeouts': self.timeouts}
+
+
+class GameServer:
+    def __init__(self, workers=2, max_queue=32, max_sessions=100000):
+        self.sessions = {}
+        self.ids = itertools.count(1)
+        self.max_sessions = max_sessions
+        self.pool = EnginePool(workers, max_queue)
+        self.latency = LatencyStats()
+        self.connections = 0
+
+    def session(self, request):
+        session = self.sessions.get(request.get('session'))
+        if session is None:
+            raise ServerError(f'unknown session {request.get("session")!r}')
+        return session
+
+    async def dispatch(self, request):
+        op = request.get('op')
+        if op == 'new':
+            if len(self.sessions) >= self.max_sessions:
+                raise ServerError('too many sessions')
+            # The position is loaded and described before the session is stored, so a bad FEN leaves nothing behind.
+            try:
+                session = Session(request.get('fen') or START_FEN)
+                state = session.describe(request.get('moves', False))
+            except ValueError as error:
+                raise ServerError(str(error)) from None
+            session_id = str(next(self.ids))
+            self.sessions[session_id] = session
+            return dict(state, session=session_id)
+        if op == 'move':
+            session = self.session(request)
+            session.legal_moves()
+            if session.status is not None:
+                raise ServerError(f'game over: {session.status}')
+            code = session.play(str(request.get('move', '')))
+            return dict(session.describe(request.get('moves', False)), move=move_notation(code))
+        if op == 'moves':
+            return self.session(request).describe(True)
+        if op == 'state':
+            session = self.session(request)
+            return dict(session.describe(), history=[move_notation(code) for code in session.codes])
+        if op == 'undo':
+            session = self.session(request)
+            session.undo()
+            return session.describe(request.get('moves', False))
+        if op == 'engine':
+            return await self.engine(request)
+        if op == 'close':
+            if self.sessions.pop(request.get('session'), None) is None:
+                raise ServerError(f'unknown session {request.get("session")!r}')
+            return {}
+        if op == 'stats':
+            return self.stats()
+        raise ServerError(f'unknown op {op!r}')
+
+    async def engine(self, request):
+        # 'deadline' (seconds) bounds queueing plus search; 'play' applies the move if the game has not moved on.
+        session = self.session(request)
+        session.legal_moves()
+        if session.status is not None:
+            raise ServerError(f'game over: {session.status}')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + float(request.get('deadline', DEFAULT_DEADLINE))
+        depth = request.get('depth')
+        movetime = request.get('movetime', None if depth else DEFAULT_MOVETIME)
+        codes = list(session.codes)
+        code, score, nodes, depth, elapsed = await self.pool.run(
+            deadline, bytes(encode(session.game_state)), float(movetime) if movetime is not None else None,
+            int(depth) if depth else None)
+        if code is None:
+            raise ServerError('no legal move')
+        reply = {'move': move_notation(code), 'score': score, 'nodes': nodes, 'depth': depth,
+                 'nps': int(nodes / max(elapsed, 1e-6))}
+        if request.get('play'):
+            if session.codes != codes or self.sessions.get(request.get('session')) is not session:
+                raise ServerError('position changed during search')
+            session.game_state.make_move(code)
+            session.codes.append(code)
+            session.legal = None
+            reply.update(session.describe(request.get('moves', False)))
+        return reply
+
+    def stats(self):
+        return {'sessions': len(self.sessions), 'connections': self.connections, 'engine': self.pool.stats(),
+                'latency': self.latency.summary()}
+
+    async def respond(self, line, writer, inflight):
+        start = time.perf_counter()
+        request = {}
+        try:
+            parsed = json.loads(line)
+            if not isinstance(parsed, dict):
+                raise ServerError('request must be a JSON object')
+            request = parsed
+            reply = dict(await self.dispatch(request), ok=True)
+        except ServerError as error:
+            reply = {'ok': False, 'error': str(error)}
+        except (ValueError, TypeError) as error:
+            reply = {'ok': False, 'error': f'bad request: {error}'}
+        except Exception as error:
+            reply = {'ok': False, 'error': f'internal error: {error!r}'}
+        finally:
+            inflight.release()
+        if 'id' in request:
+            reply['id'] = request['id']
+        op = request.get('op')
+        self.latency.record(op if op in OPS else 'invalid', time.perf_counter() - start, reply['ok'])
+        if not writer.is_closing():
+            writer.write(json.dumps(reply).encode() + b'\n')
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def handle(self, reader, writer):
+        # Each connection may have CONNECTION_INFLIGHT requests outstanding; beyond that the server stops reading
+        # from it, which pushes back on the client through the socket buffers.
+        self.connections += 1
+        inflight = asyncio.Semaphore(CONNECTION_INFLIGHT)
+        tasks = set()
+        try:
+            while True:
+                await inflight.acquire()
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, ValueError):
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    inflight.release()
+                    continue
+                task = asyncio.create_task(self.respond(line, writer, inflight))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(json.dumps(self.stats()), file=sys.stderr, flush=True)
+
+
+async def serve(args):
+    game_server = GameServer(args.workers, args.max_queue, args.max_sessions)
+    if args.unix:
+        server = await asyncio.start_unix_server(game_server.handle, path=args.unix)
+        print(f'listening on {args.unix}', file=sys.stderr, flush=True)
+    else:
+        server = await asyncio.start_server(game_server.handle, args.host, args.port)
+        print(f'listening on {args.host}:{args.port}', file=sys.stderr, flush=True)
+    reporter = asyncio.create_task(game_server.report(args.stats_interval)) if args.stats_interval else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        game_server.pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve many concurrent games over a JSON-lines socket protocol.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=2, help='engine worker processes')
+    parser.add_argument('--max-queue', type=int, default=32, help='engine requests allowed to wait for a worker')
+    parser.add_argument('--max-sessions', type=int, default=100000)
+    parser.add_argument('--stats-interval', type=float, default=0, help='print stats to stderr every N seconds')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
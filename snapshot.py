@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import pickle
+import random
+import struct
+import sys
+import time
+from array import array
+
+from bitboard import PIECES
+from engine import CAPTURE, ENPASSANT, FLAGS, KING_CASTLE, PROMOTION, QUEEN_CASTLE, GameState
+
+# A position packs into 30 bytes: the occupancy bitboard, one 4-bit PIECES index per occupied square in square
+# order (two per byte, low nibble first, at most 32 pieces), a byte with the side to move in bit 0 and castling
+# rights in bits 1-4, the en-passant square (255 for none), and the two move clocks. A game snapshot is the
+# position the game started from, a 32-bit move count and the game's moves as 16-bit codes, so decoding replays
+# them and restores the move history, undo information and repetition counts. All fields are little-endian.
+POSITION = struct.Struct('<Q16sBBHH')
+HEADER = struct.Struct('<Q16sBBHHI')
+NO_SQUARE = 255
+PIECE_CODES = {piece: index for index, piece in enumerate(PIECES)}
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def pack_position(squares, white_to_move, castling, enpassant_square, halfmove_clock, fullmove_number):
+    occupancy = 0
+    nibbles = bytearray(16)
+    count = 0
+    for square, piece in enumerate(squares):
+        if piece != '--':
+            if count == 32:
+                raise ValueError('more than 32 pieces on the board')
+            occupancy |= 1 << square
+            nibbles[count >> 1] |= PIECE_CODES[piece] << ((count & 1) << 2)
+            count += 1
+    return (occupancy, bytes(nibbles), (0 if white_to_move else 1) | castling << 1,
+            NO_SQUARE if enpassant_square is None else enpassant_square, min(halfmove_clock, 0xFFFF),
+            min(fullmove_number, 0xFFFF))
+
+
+def unpack_position(occupancy, nibbles, flags, enpassant, halfmove_clock, fullmove_number):
+    squares = ['--'] * 64
+    count = 0
+    while occupancy:
+        bit = occupancy & -occupancy
+        code = (nibbles[count >> 1] >> ((count & 1) << 2)) & 15
+        if code >= len(PIECES):
+            raise ValueError('Invalid snapshot: bad piece code')
+        squares[bit.bit_length() - 1] = PIECES[code]
+        occupancy ^= bit
+        count += 1
+    if squares.count('wK') != 1 or squares.count('bK') != 1:
+        raise ValueError('Invalid snapshot: each side needs exactly one king')
+    if enpassant != NO_SQUARE and enpassant > 63:
+        raise ValueError('Invalid snapshot: bad en-passant square')
+    return GameState.from_squares(squares, not flags & 1, (flags >> 1) & 15,
+                                  None if enpassant == NO_SQUARE else enpassant, halfmove_clock, fullmove_number)
+
+
+def start_position(game_state):
+    # Walks the undo log backwards over a copy of the board, so the live GameState is never touched.
+    squares = list(game_state.squares)
+    white_to_move = game_state.white_to_move
+    fullmove_number = game_state.fullmove_number
+    castling, enpassant_square, halfmove_clock = (game_state.castling, game_state.enpassant_square,
+                                                  game_state.halfmove_clock)
+    for code, entry in zip(reversed(game_state.move_log), reversed(game_state.undo_log)):
+        castling, enpassant_square, halfmove_clock, _, piece_captured = entry
+        start = code & 63
+        end = (code >> 6) & 63
+        flags = code & FLAGS
+        piece = squares[end]
+        squares[start] = piece[0] + 'P' if flags & PROMOTION else piece
+        squares[end] = piece_captured
+        if flags == ENPASSANT:
+            squares[end] = '--'
+            squares[(start & 56) | (end & 7)] = 'wP' if piece[0] == 'b' else 'bP'
+        elif flags == KING_CASTLE:
+            squares[end + 1] = squares[end - 1]
+            squares[end - 1] = '--'
+        elif flags == QUEEN_CASTLE:
+            squares[end - 2] = squares[end + 1]
+            squares[end + 1] = '--'
+        white_to_move = not white_to_move
+        if piece[0] == 'b':
+            fullmove_number -= 1
+    return squares, white_to_move, castling, enpassant_square, halfmove_clock, fullmove_number
+
+
+def encode_position(game_state):
+    # The current position alone: 30 bytes, no history.
+    return POSITION.pack(*pack_position(game_state.squares, game_state.white_to_move, game_state.castling,
+                                        game_state.enpassant_square, game_state.halfmove_clock,
+                                        game_state.fullmove_number))
+
+
+def decode_position(data, offset=0):
+    return unpack_position(*POSITION.unpack_from(data, offset))
+
+
+def encoded_size(game_state):
+    return HEADER.size + 2 * len(game_state.move_log)
+
+
+def encode_into(game_state, buffer, offset=0):
+    # Writes the snapshot straight into a writable buffer (bytearray, mmap, shared memory); returns its size.
+    moves = array('H', game_state.move_log)
+    if not LITTLE_ENDIAN:
+        moves.byteswap()
+    HEADER.pack_into(buffer, offset, *pack_position(*start_position(game_state)), len(moves))
+    end = offset + HEADER.size + 2 * len(moves)
+    memoryview(buffer)[offset + HEADER.size:end] = memoryview(moves).cast('B')
+    return end - offset
+
+
+def encode(game_state):
+    buffer = bytearray(encoded_size(game_state))
+    encode_into(game_state, buffer)
+    return buffer
+
+
+def decode(data, offset=0, validate=False):
+    # Accepts any buffer; the move codes are read through a memoryview without copying. With validate set, every
+    # move is checked against the legal moves of its position, which costs a move generation per ply.
+    fields = HEADER.unpack_from(data, offset)
+    game_state = unpack_position(*fields[:6])
+    start = offset + HEADER.size
+    view = memoryview(data)[start:start + 2 * fields[6]]
+    if len(view) != 2 * fields[6]:
+        raise ValueError('Invalid snapshot: truncated move list')
+    moves = view.cast('H') if LITTLE_ENDIAN else array('H', view.tobytes())
+    if not LITTLE_ENDIAN:
+        moves.byteswap()
+    for code in moves:
+        if validate and code not in game_state.get_valid_move_codes():
+            raise ValueError(f'Invalid snapshot: illegal move code {code}')
+        squares = game_state.squares
+        if squares[code & 63] == '--' or (code & CAPTURE and code & FLAGS != ENPASSANT and
+                                          squares[(code >> 6) & 63] == '--'):
+            raise ValueError(f'Invalid snapshot: move code {code} does not fit the board')
+        game_state.make_move(code)
+    return game_state
+
+
+def random_game(plies, rng):
+    game_state = GameState()
+    for _ in range(plies):
+        moves = game_state.get_valid_move_codes()
+        if not moves:
+            break
+        game_state.make_move(rng.choice(moves))
+    return game_state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare snapshot encoding with pickling on random games.')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--plies', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    games = [random_game(args.plies, rng) for _ in range(args.games)]
+    for game_state in games:
+        copy = decode(encode(game_state), validate=True)
+        if (copy.to_fen() != game_state.to_fen() or copy.move_log != game_state.move_log or
+                copy.repetitions != game_state.repetitions or copy.zobrist_key != game_state.zobrist_key):
+            print(f'round trip mismatch: {game_state.to_fen()}')
+            return 1
+
+    start = time.perf_counter()
+    blobs = [encode(game_state) for game_state in games]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for blob in blobs:
+        decode(blob)
+    decode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    positions = [encode_position(game_state) for game_state in games]
+    position_time = time.perf_counter() - start
+    for game_state, position in zip(games, positions):
+        if decode_position(position).to_fen() != game_state.to_fen():
+            print(f'position mismatch: {game_state.to_fen()}')
+            return 1
+
+    size = sum(map(len, blobs)) / len(blobs)
+    print(f'snapshot: {size:.0f} bytes/game  encode {encode_time / len(games) * 1e6:.0f} us  '
+          f'decode {decode_time / len(games) * 1e6:.0f} us')
+    print(f'position: {POSITION.size} bytes  encode {position_time / len(games) * 1e6:.1f} us')
+    print(f'fen:      {sum(len(game_state.to_fen()) for game_state in games) / len(games):.0f} bytes')
+    print(f'pickle:   {sum(len(pickle.dumps(game_state)) for game_state in games) / len(games):.0f} bytes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
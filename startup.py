@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Each case runs in a fresh interpreter, so the numbers include everything a short-lived worker or CLI pays.
+CASES = {
+    'python': 'pass',
+    'engine': 'import engine',
+    'first_moves': 'import engine; engine.GameState().get_valid_moves()',
+    'search': 'import search',
+    'uci': 'import uci',
+    'gui': 'import main',
+}
+
+
+def measure(code, runs):
+    timings = []
+    environment = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1')
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+        if completed.returncode != 0:
+            return None
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure cold start-up time of the engine entry points.')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--case', action='append', choices=sorted(CASES), help='cases to run (default: all)')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    for name in args.case or CASES:
+        timings = measure(CASES[name], args.runs)
+        if timings is None:
+            print(f'{name:<12} failed (missing dependency?)')
+            continue
+        best = min(timings) * 1000
+        if name == 'python':
+            baseline = best
+        overhead = f'  +{best - baseline:.1f} ms over bare python' if baseline is not None and name != 'python' else ''
+        print(f'{name:<12} best {best:7.1f} ms  mean {sum(timings) / len(timings) * 1000:7.1f} ms{overhead}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bitboard import KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, SQUARE_BITS, bishop_attacks, queen_attacks, \
+    rook_attacks
+from engine import PROMOTION, PROMOTION_PIECES, GameState
+
+# Tables cover a lone king against king plus one piece, always stored with white as the stronger side. A position
+# is indexed as side << 18 | white king << 12 | black king << 6 | piece square (side 0 = white to move), and each
+# entry is one byte packing the result for the side to move in bits 0-1 and the distance to mate in moves in bits
+# 2-7. A 16-byte header precedes the entries.
+TABLES = ('KQK', 'KRK', 'KBK', 'KNK', 'KPK')
+SIZE = 2 << 18
+HEADER = struct.Struct('>4sc11x')
+MAGIC = b'CTB1'
+DRAW, WIN, LOSS, ILLEGAL = range(4)
+EXTENSION = '.ctb'
+
+
+def piece_attacks(piece, square, occupied):
+    if piece == 'Q':
+        return queen_attacks(square, occupied)
+    if piece == 'R':
+        return rook_attacks(square, occupied)
+    if piece == 'B':
+        return bishop_attacks(square, occupied)
+    if piece == 'N':
+        return KNIGHT_ATTACKS[square]
+    return PAWN_ATTACKS['w'][square]
+
+
+def split_index(index):
+    return index >> 18, (index >> 12) & 63, (index >> 6) & 63, index & 63
+
+
+def initialize_chunk(piece, start, stop):
+    # Returns (legal flags, black move counts, checked flags) for indices start..stop-1. Black-to-move counts
+    # include capturing the piece, which leads to a bare-kings draw and so is never counted down.
+    legal = bytearray(stop - start)
+    counts = bytearray(stop - start)
+    checked = bytearray(stop - start)
+    for index in range(start, stop):
+        side, white_king, black_king, square = split_index(index)
+        if white_king == black_king or white_king == square or black_king == square:
+            continue
+        if KING_ATTACKS[white_king] & SQUARE_BITS[black_king]:
+            continue
+        if piece == 'P' and (square < 8 or square >= 56):
+            continue
+        occupied = SQUARE_BITS[white_king] | SQUARE_BITS[black_king] | SQUARE_BITS[square]
+        check = piece_attacks(piece, square, occupied) & SQUARE_BITS[black_king]
+        if side == 0:
+            if check:
+                continue
+        else:
+            attacked = KING_ATTACKS[white_king] | piece_attacks(piece, square, occupied ^ SQUARE_BITS[black_king])
+            counts[index - start] = bin(KING_ATTACKS[black_king] & ~attacked & ~SQUARE_BITS[white_king]).count('1')
+            checked[index - start] = 1 if check else 0
+        legal[index - start] = 1
+    return legal, counts, checked
+
+
+def promotion_seeds(tables):
+    # White-to-move pawn positions where promoting mates: (plies to mate, index) for every promotion whose
+    # resulting black-to-move position is lost in the already generated table of the new piece.
+    seeds = []
+    for white_king in range(64):
+        for black_king in range(64):
+            for square in range(8, 16):
+                target = square - 8
+                if len({white_king, black_king, square}) < 3 or target in (white_king, black_king):
+                    continue
+                for piece in 'QRBN':
+                    entry = tables.get(piece)
+                    if entry is None:
+                        continue
+                    result, plies = decode_entry(entry[1 << 18 | white_king << 12 | black_king << 6 | target])
+                    if result == LOSS:
+                        seeds.append((plies + 1, white_king << 12 | black_king << 6 | square))
+    return seeds
+
+
+def generate(piece, tables=None, workers=1, executor=None):
+    # Retrograde analysis: start from black-to-move mates and walk back through white un-moves (giving wins for
+    # white to move) and black un-moves (counting down black's escapes until every one loses). Positions are
+    # settled in order of distance, so each gets its shortest win or longest loss. Pawn tables are seeded with
+    # promotions into the tables given in `tables` (piece letter -> entries).
+    chunk = SIZE // max(workers * 4, 1)
+    ranges = [(start, min(start + chunk, SIZE)) for start in range(0, SIZE, chunk)]
+    if executor is not None:
+        parts = list(executor.map(initialize_chunk, [piece] * len(ranges), *zip(*ranges)))
+    else:
+        parts = [initialize_chunk(piece, start, stop) for start, stop in ranges]
+    legal = b''.join(part[0] for part in parts)
+    counts = bytearray(b''.join(part[1] for part in parts))
+    checked = b''.join(part[2] for part in parts)
+
+    distance = bytearray(SIZE)
+    buckets = [[]]
+    for index in range(1 << 18, SIZE):
+        if legal[index] and not counts[index] and checked[index]:
+            distance[index] = 1
+            buckets[0].append(index)
+    if piece == 'P' and tables:
+        for plies, index in promotion_seeds(tables):
+            if legal[index]:
+                while len(buckets) <= plies:
+                    buckets.append([])
+                buckets[plies].append(index)
+
+    plies = 0
+    while plies < len(buckets):
+        for index in buckets[plies]:
+            side, white_king, black_king, square = split_index(index)
+            occupied = SQUARE_BITS[white_king] | SQUARE_BITS[black_king] | SQUARE_BITS[square]
+            if side == 0:
+                if distance[index]:
+                    continue
+                distance[index] = plies + 1
+                predecessors = []
+                moves = KING_ATTACKS[black_king] & ~occupied
+                while moves:
+                    bit = moves & -moves
+                    predecessors.append(1 << 18 | white_king << 12 | (bit.bit_length() - 1) << 6 | square)
+                    moves ^= bit
+                for predecessor in predecessors:
+                    if legal[predecessor] and not distance[predecessor]:
+                        counts[predecessor] -= 1
+                        if not counts[predecessor]:
+                            distance[predecessor] = plies + 2
+                            while len(buckets) <= plies + 1:
+                                buckets.append([])
+                            buckets[plies + 1].append(predecessor)
+            else:
+                predecessors = []
+                moves = KING_ATTACKS[white_king] & ~occupied
+                while moves:
+                    bit = moves & -moves
+                    predecessors.append((bit.bit_length() - 1) << 12 | black_king << 6 | square)
+                    moves ^= bit
+                if piece == 'P':
+                    moves = 0
+                    if square + 8 < 56 and not occupied & SQUARE_BITS[square + 8]:
+                        moves = SQUARE_BITS[square + 8]
+                        if square >> 3 == 4 and not occupied & SQUARE_BITS[square + 16]:
+                            moves |= SQUARE_BITS[square + 16]
+                else:
+                    moves = piece_attacks(piece, square, occupied) & ~occupied
+                while moves:
+                    bit = moves & -moves
+                    predecessors.append(white_king << 12 | black_king << 6 | (bit.bit_length() - 1))
+                    moves ^= bit
+                for predecessor in predecessors:
+                    if legal[predecessor] and not distance[predecessor]:
+                        while len(buckets) <= plies + 1:
+                            buckets.append([])
+                        buckets[plies + 1].append(predecessor)
+        buckets[plies] = None
+        plies += 1
+
+    entries = bytearray(SIZE)
+    for index in range(SIZE):
+        if not legal[index]:
+            entries[index] = ILLEGAL
+        elif distance[index]:
+            plies = distance[index] - 1
+            if index >> 18:
+                entries[index] = LOSS | (plies // 2) << 2
+            else:
+                entries[index] = WIN | ((plies + 1) // 2) << 2
+    return bytes(entries)
+
+
+def decode_entry(entry):
+    # (result, plies to mate) for the side to move.
+    result = entry & 3
+    moves = entry >> 2
+    if result == WIN:
+        return result, moves * 2 - 1
+    if result == LOSS:
+        return result, moves * 2
+    return result, 0
+
+
+def write_table(path, piece, entries):
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, piece.encode()))
+        file.write(entries)
+
+
+def generate_table(piece, directory, dependencies=(), workers=1, executor=None):
+    # Generates one table, reading the tables its promotions lead into from disk. Called as a worker entry point
+    # with one worker, or in the parent with an executor to split the table's initialization across processes.
+    with Tablebase(directory) as tablebase:
+        tables = {dependency: tablebase.entries(dependency) for dependency in dependencies}
+    start = time.perf_counter()
+    entries = generate(piece, tables, workers, executor)
+    write_table(os.path.join(directory, f'K{piece}K{EXTENSION}'), piece, entries)
+    return piece, time.perf_counter() - start
+
+
+class Tablebase:
+    def __init__(self, directory='tables'):
+        self.directory = directory
+        self.files = {}
+        self.maps = {}
+
+    def close(self):
+        for data in self.maps.values():
+            data.close()
+        for file in self.files.values():
+            file.close()
+        self.maps.clear()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def load(self, piece):
+        # Memory-maps the table for piece on first use; returns None when the file does not exist.
+        if piece not in self.maps:
+            path = os.path.join(self.directory, f'K{piece}K{EXTENSION}')
+            if not os.path.exists(path):
+                return None
+            file = open(path, 'rb')
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, stored = HEADER.unpack_from(data, 0)
+            if magic != MAGIC or stored.decode() != piece or len(data) != HEADER.size + SIZE:
+                data.close()
+                file.close()
+                raise ValueError(f'{path} is not a {piece} table')
+            self.files[piece] = file
+            self.maps[piece] = data
+        return self.maps[piece]
+
+    def entries(self, piece):
+        data = self.load(piece)
+        return data[HEADER.size:] if data is not None else None
+
+    def probe(self, game_state):
+        # (result, plies to mate) for the side to move, with result 1 win, 0 draw, -1 loss; None when the
+        # position is not covered.
+        pieces = game_state.pieces
+        occupied = game_state.occupied
+        count = bin(occupied).count('1')
+        if count == 2:
+            return 0, 0
+        if count != 3 or game_state.castling:
+            return None
+
+        for piece in 'QRBNP':
+            if pieces['w' + piece]:
+                white_to_move = game_state.white_to_move
+                mirror = 0
+                strong, weak = 'w', 'b'
+                break
+            if pieces['b' + piece]:
+                white_to_move = not game_state.white_to_move
+                mirror = 56
+                strong, weak = 'b', 'w'
+                break
+        else:
+            return None
+
+        data = self.load(piece)
+        if data is None:
+            return None
+        index = HEADER.size + ((0 if white_to_move else 1) << 18 |
+                 ((pieces[strong + 'K'].bit_length() - 1) ^ mirror) << 12 |
+                 ((pieces[weak + 'K'].bit_length() - 1) ^ mirror) << 6 |
+                 ((pieces[strong + piece].bit_length() - 1) ^ mirror))
+        result, plies = decode_entry(data[index])
+        if result == ILLEGAL:
+            return None
+        return {WIN: 1, LOSS: -1, DRAW: 0}[result], plies
+
+    def best_move(self, game_state):
+        # Picks the fastest win, else a draw, else the longest defence; None if the position is not covered.
+        root = self.probe(game_state)
+        if root is None:
+            return None
+        best = None
+        for code in game_state.get_valid_move_codes():
+            game_state.make_move(code)
+            child = self.probe(game_state)
+            game_state.undo_move()
+            if child is None:
+                if code & PROMOTION and PROMOTION_PIECES[(code >> 12) & 3] in 'BN':
+                    child = (0, 0)
+                else:
+                    continue
+            result, plies = -child[0], child[1]
+            rank = (result, -plies if result > 0 else plies)
+            if best is None or rank > best[0]:
+                best = rank, code
+        return best[1] if best is not None else None
+
+
+def index_to_fen(piece, index):
+    side, white_king, black_king, square = split_index(index)
+    squares = ['--'] * 64
+    squares[white_king] = 'wK'
+    squares[black_king] = 'bK'
+    squares[square] = 'w' + piece
+    ranks = []
+    for row in range(8):
+        rank = ''
+        empty = 0
+        for name in squares[row * 8:row * 8 + 8]:
+            if name == '--':
+                empty += 1
+                continue
+            rank += (str(empty) if empty else '') + (name[1] if name[0] == 'w' else name[1].lower())
+            empty = 0
+        ranks.append(rank + (str(empty) if empty else ''))
+    return f"{'/'.join(ranks)} {'b' if side else 'w'} - - 0 1"
+
+
+def verify_chunk(directory, piece, indices):
+    # Replays each position through GameState: the table must agree that it is legal and its value must follow
+    # from the values after every move get_valid_move_codes produces. Returns a list of error strings.
+    errors = []
+    with Tablebase(directory) as tablebase:
+        entries = tablebase.entries(piece)
+        for index in indices:
+            result, plies = decode_entry(entries[index])
+            fen = index_to_fen(piece, index)
+            side, white_king, black_king, square = split_index(index)
+            in_check = bool(piece_attacks(piece, square, SQUARE_BITS[white_king] | SQUARE_BITS[black_king] |
+                                          SQUARE_BITS[square]) & SQUARE_BITS[black_king]) and side == 0
+            expected_legal = len({white_king, black_king, square}) == 3 and not in_check and not (
+                KING_ATTACKS[white_king] & SQUARE_BITS[black_king]) and not (piece == 'P' and not 8 <= square < 56)
+            if (result != ILLEGAL) != expected_legal:
+                errors.append(f'{fen}: legality mismatch')
+                continue
+            if result == ILLEGAL:
+                continue
+
+            game_state = GameState.from_fen(fen)
+            children = []
+            for code in game_state.get_valid_move_codes():
+                game_state.make_move(code)
+                child = tablebase.probe(game_state)
+                game_state.undo_move()
+                if child is None:
+                    child = (0, 0)
+                children.append(child)
+
+            if not children:
+                expected = (-1, 0) if game_state.checkmate else (0, 0)
+            elif any(child[0] < 0 for child in children):
+                expected = (1, min(child[1] for child in children if child[0] < 0) + 1)
+            elif all(child[0] > 0 for child in children):
+                expected = (-1, max(child[1] for child in children) + 1)
+            else:
+                expected = (0, 0)
+            if tablebase.probe(game_state) != expected:
+                errors.append(f'{fen}: table {tablebase.probe(game_state)} expected {expected}')
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate, verify or probe king-and-piece versus king tables.')
+    parser.add_argument('--directory', default='tables')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('generate', help='generate every table')
+    verify = commands.add_parser('verify', help='check table values against the engine move generator')
+    verify.add_argument('--samples', type=int, default=20000, help='positions per table (0 for all)')
+    probe = commands.add_parser('probe', help='probe a position')
+    probe.add_argument('fen')
+    args = parser.parse_args(argv)
+
+    if args.command == 'probe':
+        game_state = GameState.from_fen(args.fen)
+        with Tablebase(args.directory) as tablebase:
+            result = tablebase.probe(game_state)
+            if result is None:
+                print('not in tables')
+                return 1
+            move = tablebase.best_move(game_state)
+        print(f'{("loss", "draw", "win")[result[0] + 1]}  plies to mate: {result[1]}  '
+              f'best move: {game_state.decode_move(move).get_chess_notation() if move is not None else "-"}')
+        return 0
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        if args.command == 'generate':
+            os.makedirs(args.directory, exist_ok=True)
+            # Pawn promotions read the piece tables, so those are built first, one per process. KPK is then built
+            # alone, with its move counting split across the pool; the retrograde walk itself is sequential.
+            futures = [executor.submit(generate_table, piece, args.directory) for piece in ('Q', 'R', 'B', 'N')]
+            for future in futures:
+                piece, elapsed = future.result()
+                print(f'K{piece}K generated in {elapsed:.1f}s')
+            piece, elapsed = generate_table('P', args.directory, ('Q', 'R'), args.workers, executor)
+            print(f'K{piece}K generated in {elapsed:.1f}s')
+            print(f'total: {time.perf_counter() - start:.1f}s')
+            return 0
+
+        failures = 0
+        for name in TABLES:
+            piece = name[1]
+            indices = list(range(SIZE))
+            if args.samples:
+                indices = random.Random(0).sample(indices, min(args.samples, SIZE))
+            size = -(-len(indices) // (args.workers * 4))
+            chunks = [indices[offset:offset + size] for offset in range(0, len(indices), size)]
+            errors = [error for part in executor.map(verify_chunk, [args.directory] * len(chunks),
+                                                     [piece] * len(chunks), chunks) for error in part]
+            failures += len(errors)
+            for error in errors[:10]:
+                print(error)
+            print(f'{name}: {len(indices)} positions checked, {len(errors)} errors')
+        print(f'total: {time.perf_counter() - start:.1f}s')
+        return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+
+EXACT = 1
+LOWER = 2
+UPPER = 3
+
+ENTRY_SIZE = 16
+BUCKET_SIZE = 2
+SCORE_OFFSET = 1 << 31
+AGE_MASK = 63
+
+
+class TranspositionTable:
+    # Each bucket holds a depth-preferred slot followed by an always-replace slot. An entry is a 64-bit key and a
+    # 64-bit word packing move (16 bits), score (32 bits), depth (8 bits), bound (2 bits) and age (6 bits).
+    def __init__(self, size_mb=16):
+        self.resize(size_mb)
+
+    def resize(self, size_mb):
+        buckets = 1
+        while buckets * 2 * BUCKET_SIZE * ENTRY_SIZE <= size_mb * 1024 * 1024:
+            buckets *= 2
+        self.size_mb = size_mb
+        self.mask = buckets - 1
+        self.keys = array('Q', bytes(8 * BUCKET_SIZE * buckets))
+        self.data = array('Q', bytes(8 * BUCKET_SIZE * buckets))
+        self.age = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.collisions = 0
+
+    def clear(self):
+        self.keys = array('Q', bytes(len(self.keys) * 8))
+        self.data = array('Q', bytes(len(self.data) * 8))
+        self.age = 0
+        self.reset_stats()
+
+    def new_search(self):
+        self.age = (self.age + 1) & AGE_MASK
+
+    def probe(self, key):
+        self.probes += 1
+        index = (key & self.mask) * BUCKET_SIZE
+        keys = self.keys
+        if keys[index] == key:
+            word = self.data[index]
+        elif keys[index + 1] == key:
+            word = self.data[index + 1]
+        else:
+            return None
+        if not word:
+            return None
+
+        self.hits += 1
+        return (word & 0xFFFF, ((word >> 16) & 0xFFFFFFFF) - SCORE_OFFSET, (word >> 48) & 0xFF,
+                (word >> 56) & 3)
+
+    def store(self, key, depth, bound, score, move):
+        self.stores += 1
+        index = (key & self.mask) * BUCKET_SIZE
+        keys = self.keys
+        data = self.data
+        word = (move & 0xFFFF | (score + SCORE_OFFSET) << 16 | min(max(depth, 0), 255) << 48 | bound << 56 |
+                self.age << 58)
+
+        if keys[index] == key:
+            if not move:
+                word |= data[index] & 0xFFFF
+            if depth >= (data[index] >> 48) & 0xFF or bound == EXACT:
+                data[index] = word
+                return
+            slot = index + 1
+        else:
+            stored = data[index]
+            if not stored or depth >= (stored >> 48) & 0xFF or (stored >> 58) != self.age:
+                slot = index
+            else:
+                slot = index + 1
+
+        if data[slot] and keys[slot] != key:
+            self.collisions += 1
+        keys[slot] = key
+        data[slot] = word
+
+    def hashfull(self):
+        # Permille of the first thousand slots written during the current search, as reported by UCI engines.
+        sample = min(1000, len(self.data))
+        used = sum(1 for word in self.data[:sample] if word and word >> 58 == self.age)
+        return used * 1000 // sample
+
+    def get_stats(self):
+        return {
+            'size_mb': self.size_mb,
+            'entries': len(self.keys),
+            'probes': self.probes,
+            'hits': self.hits,
+            'stores': self.stores,
+            'collisions': self.collisions,
+            'hit_rate': self.hits / self.probes if self.probes else 0.0,
+            'hashfull': self.hashfull(),
+            'age': self.age,
+        }
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import threading
+
+import instrument
+
+from engine import PROMOTION, PROMOTION_PIECES, SQUARE_NAMES, START_FEN, GameState
+from search import MATE, MATE_BOUND, SearchLimits, search
+from tt import TranspositionTable
+
+ENGINE_NAME = 'ChessEngine'
+ENGINE_AUTHOR = 'DevilJamJar'
+DEFAULT_HASH_MB = 16
+MOVE_OVERHEAD = 0.05
+
+
+def format_score(score):
+    if score >= MATE_BOUND:
+        return f'mate {(MATE - score + 1) // 2}'
+    if score <= -MATE_BOUND:
+        return f'mate -{(MATE + score) // 2}'
+    return f'cp {score}'
+
+
+def move_notation(code):
+    notation = SQUARE_NAMES[code & 63] + SQUARE_NAMES[(code >> 6) & 63]
+    if code & PROMOTION:
+        notation += PROMOTION_PIECES[(code >> 12) & 3].lower()
+    return notation
+
+
+def allocate_time(options, white_to_move):
+    # Returns the search time in seconds for a 'go' command, or None when the clock does not limit the search.
+    if 'movetime' in options:
+        return max(options['movetime'] / 1000 - MOVE_OVERHEAD, 0.01)
+    remaining = options.get('wtime' if white_to_move else 'btime')
+    if remaining is None:
+        return None
+    increment = options.get('winc' if white_to_move else 'binc', 0)
+    moves_to_go = options.get('movestogo', 30)
+    budget = remaining / max(moves_to_go, 1) + increment * 0.75
+    return max(min(budget, remaining - MOVE_OVERHEAD * 1000) / 1000, 0.01)
+
+
+class UCIEngine:
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.game_state = GameState()
+        self.tt = TranspositionTable(DEFAULT_HASH_MB)
+        self.stop_event = threading.Event()
+        self.search_thread = None
+        self.book = None
+        self.tablebase = None
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def handle(self, line):
+        # Returns False once the engine should exit.
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, arguments = tokens[0], tokens[1:]
+
+        if command == 'uci':
+            self.send(f'id name {ENGINE_NAME}')
+            self.send(f'id author {ENGINE_AUTHOR}')
+            self.send(f'option name Hash type spin default {DEFAULT_HASH_MB} min 1 max 1024')
+            self.send('option name BookFile type string default <empty>')
+            self.send('option name TablebasePath type string default <empty>')
+            self.send('uciok')
+        elif command == 'isready':
+            self.send('readyok')
+        elif command == 'ucinewgame':
+            self.stop()
+            self.tt.clear()
+            self.game_state = GameState()
+        elif command == 'setoption':
+            self.set_option(arguments)
+        elif command == 'position':
+            self.stop()
+            self.set_position(arguments)
+        elif command == 'go':
+            self.stop()
+            self.go(arguments)
+        elif command == 'stop':
+            self.stop()
+        elif command == 'd':
+            self.send(self.game_state.to_fen())
+        elif command == 'quit':
+            self.stop()
+            return False
+        return True
+
+    def set_option(self, arguments):
+        if 'name' not in arguments:
+            return
+        value_index = arguments.index('value') if 'value' in arguments else len(arguments)
+        name = ' '.join(arguments[arguments.index('name') + 1:value_index]).lower()
+        value = ' '.join(arguments[value_index + 1:])
+        if name == 'hash' and value.isdigit():
+            self.stop()
+            self.tt.resize(max(1, min(int(value), 1024)))
+        elif name == 'bookfile':
+            if self.book is not None:
+                self.book.close()
+                self.book = None
+            if value and value != '<empty>':
+                # Imported here: the book module pulls in the PGN reader, which most sessions never need.
+                from book import OpeningBook
+                try:
+                    self.book = OpeningBook(value)
+                except OSError as error:
+                    self.send(f'info string cannot open book: {error}')
+        elif name == 'tablebasepath':
+            self.stop()
+            if self.tablebase is not None:
+                self.tablebase.close()
+                self.tablebase = None
+            if value and value != '<empty>':
+                if os.path.isdir(value):
+                    from tablebase import Tablebase
+                    self.tablebase = Tablebase(value)
+                else:
+                    self.send(f'info string no tablebase directory: {value}')
+
+    def set_position(self, arguments):
+        if 'moves' in arguments:
+            moves = arguments[arguments.index('moves') + 1:]
+            arguments = arguments[:arguments.index('moves')]
+        else:
+            moves = []
+        try:
+            if arguments and arguments[0] == 'fen':
+                game_state = GameState.from_fen(' '.join(arguments[1:]))
+            else:
+                game_state = GameState.from_fen(START_FEN)
+        except ValueError as error:
+            self.send(f'info string {error}')
+            return
+
+        for notation in moves:
+            for code in game_state.get_valid_move_codes():
+                if move_notation(code) == notation:
+                    game_state.make_move(code)
+                    break
+            else:
+                self.send(f'info string illegal move {notation}')
+                break
+        self.game_state = game_state
+
+    def go(self, arguments):
+        options = {}
+        infinite = False
+        for index, token in enumerate(arguments):
+            if token == 'infinite':
+                infinite = True
+            elif token in ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'movetime', 'depth', 'nodes') and \
+                    index + 1 < len(arguments) and arguments[index + 1].lstrip('-').isdigit():
+                options[token] = int(arguments[index + 1])
+
+        # Book moves are answered on the spot, without a search thread.
+        if self.book is not None and not infinite:
+            code = self.book.choose(self.game_state)
+            if code is not None:
+                self.send('info string book move')
+                self.send(f'bestmove {move_notation(code)}')
+                return
+
+        movetime = None if infinite else allocate_time(options, self.game_state.white_to_move)
+        limits = SearchLimits(options.get('depth'), movetime, options.get('nodes'))
+        self.stop_event.clear()
+        self.search_thread = threading.Thread(target=self.run_search, args=(limits, infinite), daemon=True)
+        self.search_thread.start()
+
+    def run_search(self, limits, infinite):
+        result = search(self.game_state, limits, self.tt, self.stop_event, self.report, self.tablebase)
+        # In infinite mode the GUI expects bestmove only after it sends 'stop'.
+        if infinite:
+            self.stop_event.wait()
+        if result.best_move is None:
+            self.send('bestmove 0000')
+        else:
+            self.send(f'bestmove {move_notation(result.best_move.code)}')
+
+    def report(self, depth, score, pv, nodes, elapsed):
+        self.send(f'info depth {depth} score {format_score(score)} nodes {nodes} nps {int(nodes / max(elapsed, 1e-6))} '
+                  f'time {int(elapsed * 1000)} hashfull {self.tt.hashfull()} pv {" ".join(map(move_notation, pv))}')
+
+    def stop(self):
+        if self.search_thread is not None:
+            self.stop_event.set()
+            self.search_thread.join()
+            self.search_thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the engine over the UCI protocol on stdin/stdout.')
+    parser.add_argument('--profile', nargs='?', const='uci.prof', metavar='PATH',
+                        help='instrument the engine and write pstats-compatible stats to PATH on quit')
+    args = parser.parse_args(argv)
+
+    with instrument.profiling(args.profile):
+        uci_engine = UCIEngine()
+        for line in sys.stdin:
+            if not uci_engine.handle(line):
+                break
+        uci_engine.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from bitboard import PAWN_ATTACKS, PIECES
+
+
+def splitmix64(seed, count):
+    # Small deterministic generator; avoids importing random (and hashlib with it) on every start-up.
+    keys = []
+    for _ in range(count):
+        seed = (seed + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        key = seed
+        key = ((key ^ (key >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        key = ((key ^ (key >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        keys.append(key ^ (key >> 31))
+    return keys
+
+
+# A fixed seed gives every process the same keys, so pool workers and the parent agree on hashes. The keys are
+# never written to disk (opening books use the Polyglot hash), so the generator can change between versions.
+_keys = splitmix64(0x5EED, 64 * len(PIECES) + 1 + 16 + 8)
+PIECE_KEYS = {piece: _keys[index * 64:index * 64 + 64] for index, piece in enumerate(PIECES)}
+SIDE_KEY = _keys[64 * len(PIECES)]
+CASTLING_KEYS = _keys[64 * len(PIECES) + 1:64 * len(PIECES) + 17]
+ENPASSANT_KEYS = _keys[64 * len(PIECES) + 17:]
+
+
+def enpassant_key(squares, enpassant_square, white_to_move):
+    # The en-passant file only counts when a pawn could actually capture there.
+    if white_to_move:
+        capturers = PAWN_ATTACKS['b'][enpassant_square]
+        pawn = 'wP'
+    else:
+        capturers = PAWN_ATTACKS['w'][enpassant_square]
+        pawn = 'bP'
+    while capturers:
+        bit = capturers & -capturers
+        if squares[bit.bit_length() - 1] == pawn:
+            return ENPASSANT_KEYS[enpassant_square & 7]
+        capturers ^= bit
+    return 0
+
+
+def hash_position(squares, white_to_move, castling_mask, enpassant_square):
+    key = 0
+    for square, piece in enumerate(squares):
+        if piece != '--':
+            key ^= PIECE_KEYS[piece][square]
+    if not white_to_move:
+        key ^= SIDE_KEY
+    key ^= CASTLING_KEYS[castling_mask]
+    if enpassant_square is not None:
+        key ^= enpassant_key(squares, enpassant_square, white_to_move)
+    return key